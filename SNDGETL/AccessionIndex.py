@@ -0,0 +1,112 @@
+import sqlite3
+import logging
+
+from SNDGETL import init_log
+
+_log = logging.getLogger(__name__)
+
+
+class AccessionIndex:
+    """
+    On disk accession <-> publication <-> category index of the extracted
+    links, so "which publications cite accession X" and "all the accessions
+    of pmid Y" are answered without reading the csv files.
+
+    The table is clustered by accession and a covering index orders the same
+    rows by publication, so both lookups are a single index range scan.
+    Every run adds its links to the same file (repeated ones are ignored);
+    they are stored by commit(), once the extraction finished.
+    """
+    COLUMNS = ("accession", "scheme", "category", "title", "publication", "publication_scheme")
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS links (
+                                accession TEXT, scheme TEXT, category TEXT, title TEXT,
+                                publication TEXT, publication_scheme TEXT,
+                                PRIMARY KEY (accession, publication, category, scheme, publication_scheme))
+                                WITHOUT ROWID""")
+        self._db.execute("""CREATE INDEX IF NOT EXISTS links_publication
+                                ON links (publication, accession, category, scheme, publication_scheme, title)""")
+        self._db.commit()
+
+    def add(self, links):
+        """links: (category, scheme, accession, title, publication_scheme, publication) tuples"""
+        self._db.executemany("INSERT OR IGNORE INTO links VALUES (?, ?, ?, ?, ?, ?)",
+                             [(accession, scheme, category, title, publication, publication_scheme)
+                              for category, scheme, accession, title, publication_scheme, publication in links])
+
+    def _select(self, where, params, category=None):
+        query = f"SELECT {', '.join(AccessionIndex.COLUMNS)} FROM links WHERE {where}"
+        if category:
+            query += " AND category = ?"
+            params = list(params) + [category]
+        return [dict(zip(AccessionIndex.COLUMNS, row)) for row in self._db.execute(query, params)]
+
+    def publications(self, accession, category=None):
+        """links of the publications that reference the accession"""
+        return self._select("accession = ?", [accession], category)
+
+    def accessions(self, publication, category=None):
+        """links of the accessions referenced by a publication (pmid or other EuroPMC id)"""
+        return self._select("publication = ?", [publication], category)
+
+    def stats(self):
+        """{category: links}"""
+        return dict(self._db.execute("SELECT category, COUNT(*) FROM links GROUP BY category ORDER BY category"))
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import json
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Looks up the accession index built by EBIAccessionExtractor --index')
+
+    parser.add_argument('index', action='store', help="sqlite file built with EBIAccessionExtractor --index")
+    parser.add_argument('-v', '--verbose', action="store_true")
+    parser.add_argument('-s', '--silent', action="store_true")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    accession_subparser = subparsers.add_parser('accession', help="publications that reference the accessions")
+    accession_subparser.add_argument('accessions', action='store', nargs="+")
+    publication_subparser = subparsers.add_parser('publication', help="accessions referenced by the publications")
+    publication_subparser.add_argument('publications', action='store', nargs="+")
+    for subparser in (accession_subparser, publication_subparser):
+        subparser.add_argument('--category', action='store', default=None,
+                               help="only links of this category, ex: 'Nucleotide Sequences'")
+    subparsers.add_parser('stats', help="links per category")
+
+    args = parser.parse_args()
+
+    if not args.verbose:
+        if os.environ.get('VERBOSE'):
+            args.verbose = True
+
+    if args.silent:
+        _log.disabled = True
+
+    init_log(rootloglevel=logging.DEBUG if args.verbose else logging.INFO)
+
+    if not os.path.exists(args.index):
+        parser.error(f"'{args.index}' does not exist")
+    index = AccessionIndex(args.index)
+    if args.command == "stats":
+        sys.stdout.write(json.dumps(index.stats(), indent=2) + "\n")
+    else:
+        keys = args.accessions if args.command == "accession" else args.publications
+        lookup = index.publications if args.command == "accession" else index.accessions
+        for key in keys:
+            for link in lookup(key, args.category):
+                sys.stdout.write(json.dumps(link) + "\n")
+    index.close()
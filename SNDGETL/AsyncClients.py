@@ -0,0 +1,381 @@
+'''
+asyncio versions of the EuroPMC, EBISearch, EuroPMCLinks and EBIENAAPI clients,
+for services that fan out thousands of lookups from one event loop.
+They yield the same records as the blocking clients. Requires aiohttp.
+'''
+import json
+import math
+import time
+import queue
+import asyncio
+import logging
+import contextlib
+import threading
+import xml.etree.ElementTree as ET
+from urllib.parse import urlparse, urlencode
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from SNDGETL import ProcessingException
+from SNDGETL.EBIENAAPI import EBIENAAPI, accession_batches, element_to_dict
+from SNDGETL.EBISearch import EBISearch
+from SNDGETL.EuroPMC import EuroPMC
+from SNDGETL.EuroPMCLinks import EuroPMCLinks
+from SNDGETL.Governor import Governor
+from SNDGETL.Metrics import Metrics, metrics
+from SNDGETL.Transport import Transport
+
+_log = logging.getLogger(__name__)
+
+
+class AsyncTransport:
+    """
+    aiohttp counterpart of Transport: one connection pool shared by all the
+    async clients, a semaphore that bounds the requests in flight, and the
+    same rate limiter / Governor retries and optional ResponseCache.
+    """
+    DEFAULT_CONCURRENCY = 32
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, timeout=Transport.DEFAULT_TIMEOUT, rate_limiter=None,
+                 cache=None, offline=False):
+        if aiohttp is None:
+            raise ImportError("the async clients require aiohttp: pip install aiohttp")
+        self.concurrency = concurrency
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.rate_limiter = rate_limiter if rate_limiter is not None else Governor()
+        self.cache = cache
+        self.offline = offline
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _ensure_session(self):
+        if self._session is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._session = aiohttp.ClientSession(
+                timeout=self.timeout, connector=aiohttp.TCPConnector(limit=self.concurrency),
+                headers={"Accept-Encoding": "gzip, deflate"})
+        return self._session
+
+    @staticmethod
+    def _full_url(url, params):
+        return url + ("&" if "?" in url else "?") + urlencode(params) if params else url
+
+    def _cached(self, full_url):
+        """the cached body of the url, None if it has to be requested"""
+        if self.cache is not None:
+            cached = self.cache.get(full_url, expired=self.offline)
+            if cached:
+                metrics.request(full_url, 0, 200, from_cache=True)
+                return cached[0]
+        if self.offline:
+            raise ProcessingException("running offline and the response is not cached", data=[full_url])
+        return None
+
+    @contextlib.asynccontextmanager
+    async def _response(self, url, params=None, headers=None):
+        """
+        the first successful response of a GET, retried like Transport, with its body not read yet.
+        The request holds its semaphore slot until the caller leaves the block
+        """
+        session = self._ensure_session()
+        full_url = self._full_url(url, params)
+        host = urlparse(url).netloc
+        attempt = 0
+        async with self._semaphore:
+            while True:
+                await asyncio.sleep(self.rate_limiter.reserve(host))
+                start = time.perf_counter()
+                try:
+                    response = await session.get(full_url, headers=headers)
+                    self.rate_limiter.record(host, _StatusView(response))
+                    if response.status < 400:
+                        break
+                    async with response:
+                        body = await response.read()
+                    metrics.request(full_url, time.perf_counter() - start, response.status, len(body))
+                    delay = self.rate_limiter.retry_delay(attempt, _StatusView(response))
+                    if delay is None:
+                        ex = ProcessingException("error in http request",
+                                                 data=[url, params, response.status, body[:1000]])
+                        logging.error("error executing page handler", exc_info=ex)
+                        raise ex
+                    _log.warning(f"http {response.status} from {host}, retry {attempt + 1} in {delay:.1f}s")
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+                    metrics.inc("http_errors_total", error=ex.__class__.__name__, endpoint=Metrics.endpoint_label(url))
+                    delay = self.rate_limiter.retry_delay(attempt)
+                    if delay is None:
+                        raise
+                    _log.warning(f"{ex.__class__.__name__} requesting {host}, retry {attempt + 1} in {delay:.1f}s")
+                metrics.inc("http_retries_total", endpoint=Metrics.endpoint_label(url))
+                await asyncio.sleep(delay)
+                attempt += 1
+
+            # outside of the retry loop: an error reading the body is the caller's, not retried
+            async with response:
+                try:
+                    yield response
+                finally:
+                    metrics.request(full_url, time.perf_counter() - start, response.status,
+                                    response.content.total_bytes)
+
+    async def get(self, url, params=None, headers=None):
+        """returns the body of a successful GET, raises ProcessingException otherwise"""
+        full_url = self._full_url(url, params)
+        cached = self._cached(full_url)
+        if cached is not None:
+            return cached
+        async with self._response(url, params, headers) as response:
+            body = await response.read()
+            if self.cache is not None:
+                self.cache.put(full_url, body, response.headers.get("Content-Type"))
+        return body
+
+    async def stream(self, url, params=None, headers=None, chunk_size=64 * 1024):
+        """
+        async generator of the body of a successful GET in chunks, as they arrive.
+        With a cache the body is read whole, to store it, and yielded as one chunk
+        """
+        if self.cache is not None or self.offline:
+            yield await self.get(url, params, headers)
+            return
+        async with self._response(url, params, headers) as response:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def get_json(self, url, params=None):
+        body = await self.get(url, params=params, headers={"Accept": "application/json"})
+        with metrics.timer("parse_seconds", client="async"):
+            return json.loads(body)
+
+
+class _StatusView:
+    """the status_code / ok / headers subset of a requests.Response the Governor looks at"""
+
+    def __init__(self, response):
+        self.status_code = response.status
+        self.ok = response.status < 400
+        self.headers = response.headers
+
+
+class AsyncEuroPMC:
+    def __init__(self, endpoint=EuroPMC.DEFAULT_ENDPOINT, transport=None):
+        self.endpoint = endpoint
+        self.transport = transport or AsyncTransport()
+        self.total = None
+
+    async def query(self, query, pageSize=100, resultType=None, fields=None, **queryParams):
+        """async generator of [doc, total, position], like EuroPMC.query"""
+        params = dict(queryParams)
+        params.update({"query": query, "pageSize": pageSize, "format": "json",
+                       "resulttype": resultType or EuroPMC.result_type_for(fields)})
+        data = await self.transport.get_json(self.endpoint, params)
+        curr_page = queryParams.get("offSet", 0)
+        while True:
+            self.total = int(data["hitCount"])
+            for idx, doc in enumerate(data.get("resultList", {}).get("result") or [], 1):
+                if fields:
+                    doc = EuroPMC.project(doc, fields)
+                yield [doc, self.total, curr_page * pageSize + idx]
+            next_page_url = data.get("nextPageUrl")
+            curr_page += 1
+            if not next_page_url or curr_page >= math.ceil(self.total / pageSize):
+                break
+            data = await self.transport.get_json(next_page_url)
+
+
+class AsyncEBISearch:
+    def __init__(self, domain=EBISearch.DEFAULT_DB, endpoint=EBISearch.DEFAULT_ENDPOINT, page_size=100,
+                 transport=None, fields=None):
+        self.domain = domain
+        self.endpoint = endpoint
+        self.page_size = page_size
+        self.transport = transport or AsyncTransport()
+        self.fields = fields
+        self.total = None
+
+    async def _fetch(self, query, start):
+        params = {"query": query, "size": self.page_size, "start": start}
+        if self.fields:
+            params["fields"] = ",".join(self.fields)
+        return await self.transport.get_json(self.endpoint + self.domain, params)
+
+    async def query(self, query, start=0, prefetch=4):
+        """
+        async generator of [doc, total, idx], like EBISearch.query. Once the
+        first page gives the hitCount, the next prefetch pages are requested
+        concurrently and yielded in order.
+        """
+        data = await self._fetch(query, start)
+        self.total = int(data["hitCount"])
+        for idx, doc in enumerate(data.get("entries") or [], start + 1):
+            yield [doc, self.total, idx]
+        offsets = list(range(start + self.page_size, self.total, self.page_size))
+        pending = [asyncio.ensure_future(self._fetch(query, offset)) for offset in offsets[:prefetch]]
+        try:
+            for i, offset in enumerate(offsets):
+                data = await pending[i]
+                if i + prefetch < len(offsets):
+                    pending.append(asyncio.ensure_future(self._fetch(query, offsets[i + prefetch])))
+                for idx, doc in enumerate(data.get("entries") or [], offset + 1):
+                    yield [doc, self.total, idx]
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class AsyncEuroPMCLinks:
+    def __init__(self, endpoint=EuroPMCLinks.DEFAULT_ENDPOINT, transport=None):
+        self.endpoint = endpoint
+        self.transport = transport or AsyncTransport()
+
+    async def query(self, source, pmcid):
+        """the data link categories of an article, like EuroPMCLinks.query"""
+        data = await self.transport.get_json(self.endpoint.format(source=source, pmcid=pmcid))
+        if data["hitCount"] > 0:
+            return data["dataLinkList"]["Category"]
+        return []
+
+    async def query_many(self, source, pmcids, ordered=False):
+        """
+        async generator of (pmcid, categories, exception) for any number of ids,
+        (source, id) tuples override the source. Concurrency is bounded by the transport.
+        """
+
+        async def one(pmcid):
+            try:
+                if isinstance(pmcid, tuple):
+                    return pmcid, await self.query(*pmcid), None
+                return pmcid, await self.query(source, pmcid), None
+            except Exception as ex:
+                return pmcid, None, ex
+
+        async for result in _bounded_gather(one, pmcids, self.transport.concurrency * 2, ordered):
+            yield result
+
+
+class AsyncEBIENAAPI:
+    def __init__(self, endpoint=EBIENAAPI.DEFAULT_ENDPOINT, transport=None):
+        self.endpoint = endpoint
+        self.transport = transport or AsyncTransport()
+
+    async def query(self, accessions):
+        """async generator of the records of the xml set, like EBIENAAPI.query"""
+        parser = ET.XMLPullParser(events=("start", "end"))
+        depth = 0
+        root = None
+        async for chunk in self.transport.stream(self.endpoint.format(accession=",".join(accessions))):
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == "start":
+                    if root is None:
+                        root = element
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 1:
+                        yield element_to_dict(element)
+                        root.clear()
+        parser.close()
+
+    async def query_batched(self, accessions, batch_size=EBIENAAPI.DEFAULT_BATCH_SIZE, ordered=True):
+        """async generator of (batch, records, exception), like EBIENAAPI.query_batched"""
+
+        async def one(batch):
+            try:
+                return batch, [record async for record in self.query(batch)], None
+            except Exception as ex:
+                return batch, None, ex
+
+        async for result in _bounded_gather(one, accession_batches(accessions, self.endpoint, batch_size),
+                                            self.transport.concurrency, ordered):
+            yield result
+
+
+async def _bounded_gather(func, items, max_in_flight, ordered):
+    """asyncio version of ParallelFetcher.map: at most max_in_flight coroutines pending"""
+    items = iter(items)
+    pending = []
+    try:
+        for item in items:
+            pending.append(asyncio.ensure_future(func(item)))
+            if len(pending) >= max_in_flight:
+                break
+        while pending:
+            if ordered:
+                done = [pending.pop(0)]
+                await done[0]
+            else:
+                finished, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                done = [task for task in pending if task in finished]
+                pending = [task for task in pending if task not in finished]
+            for task in done:
+                yield task.result()
+            for item in items:
+                pending.append(asyncio.ensure_future(func(item)))
+                if len(pending) >= max_in_flight:
+                    break
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def iterate_sync(async_iterable_factory, buffer_size=100):
+    """
+    Runs an async generator in an event loop in a background thread and yields
+    its items to blocking code, so the async clients can be used from the CLIs:
+
+        async def publications():
+            async with AsyncTransport() as transport:
+                async for result in AsyncEuroPMC(transport=transport).query("AFF:Argentina"):
+                    yield result
+
+        for doc, total, idx in iterate_sync(publications):
+    """
+    buffer = queue.Queue(maxsize=buffer_size)
+    end = object()
+    stop = threading.Event()
+
+    async def put(entry):
+        while not stop.is_set():
+            try:
+                buffer.put_nowait(entry)
+                return True
+            except queue.Full:
+                await asyncio.sleep(0.01)
+        return False
+
+    async def produce():
+        try:
+            async for item in async_iterable_factory():
+                if not await put((item, None)):
+                    return
+            await put((end, None))
+        except Exception as ex:
+            await put((end, ex))
+
+    thread = threading.Thread(target=asyncio.run, args=(produce(),), daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, ex = buffer.get()
+            if ex:
+                raise ex
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
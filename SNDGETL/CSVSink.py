@@ -0,0 +1,126 @@
+import io
+import os
+import csv
+import math
+import hashlib
+import logging
+
+_log = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """Fixed size set of hashes with `error_rate` false positives once `capacity` keys were added"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def add(self, key):
+        """adds the key, returns True when it was (probably) already there"""
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        present = True
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.size
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self.bits[byte] & mask:
+                present = False
+                self.bits[byte] |= mask
+        return present
+
+
+class RowDedup:
+    """
+    Remembers the rows already written: dedup="exact" keeps all of them, "bloom"
+    uses a BloomFilter of bloom_capacity rows (bounded memory, a few new rows
+    may be taken as repeated) and None lets everything through.
+    """
+
+    def __init__(self, dedup="exact", bloom_capacity=None):
+        if dedup == "exact":
+            self.seen = set()
+        elif dedup == "bloom":
+            self.seen = BloomFilter(bloom_capacity or CSVSink.DEFAULT_BLOOM_CAPACITY)
+        else:
+            self.seen = None
+        self.duplicates = 0
+
+    def is_new(self, row):
+        if self.seen is None:
+            return True
+        if isinstance(self.seen, set):
+            if row in self.seen:
+                self.duplicates += 1
+                return False
+            self.seen.add(row)
+        elif self.seen.add("\x1f".join(map(str, row))):
+            self.duplicates += 1
+            return False
+        return True
+
+
+class CSVSink:
+    """
+    Buffered csv writer that drops repeated rows (see RowDedup for the dedup
+    modes). With max_bytes the output is split in numbered files:
+    seqs.csv -> seqs.00000.csv, seqs.00001.csv, ...
+    """
+    DEFAULT_BUFFER_SIZE = 1024 ** 2
+    DEFAULT_BLOOM_CAPACITY = 10 ** 7
+
+    def __init__(self, path, dedup="exact", bloom_capacity=DEFAULT_BLOOM_CAPACITY,
+                 buffer_size=DEFAULT_BUFFER_SIZE, max_bytes=None):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.max_bytes = max_bytes
+        self.dedup = RowDedup(dedup, bloom_capacity)
+        self.rows = 0
+        self.shard = 0
+        self.paths = []
+        self._size = 0
+        self._handle = None
+        self._line = io.StringIO()
+        self._writer = csv.writer(self._line, lineterminator="\n")
+        self._open()
+
+    def _open(self):
+        if self.max_bytes:
+            base, ext = os.path.splitext(self.path)
+            path = f"{base}.{self.shard:05d}{ext}"
+            self.shard += 1
+        else:
+            path = self.path
+        self.paths.append(path)
+        self._size = 0
+        self._handle = open(path, "wb", buffering=self.buffer_size)
+
+    def write(self, row):
+        """writes the row unless it was already written, returns whether it was written"""
+        if not self.dedup.is_new(row):
+            return False
+
+        self._writer.writerow(row)
+        data = self._line.getvalue().encode()
+        self._line.seek(0)
+        self._line.truncate()
+
+        if self.max_bytes and self._size and self._size + len(data) > self.max_bytes:
+            self.close()
+            self._open()
+        self._handle.write(data)
+        self._size += len(data)
+        self.rows += 1
+        return True
+
+    def close(self):
+        if self._handle:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
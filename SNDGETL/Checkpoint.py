@@ -0,0 +1,48 @@
+import os
+import json
+import logging
+
+_log = logging.getLogger(__name__)
+
+
+class Checkpoint:
+    """
+    Small json state file for long harvests. It is rewritten atomically after
+    every page that has been flushed to the output, together with the size of
+    the output at that point, so a resumed run can drop a half written page
+    and continue from the following one without duplicates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as h:
+                self.state = json.load(h)
+
+    def save(self, output=None, **state):
+        if output is not None:
+            output.flush()
+            if output.fileno() > 2:
+                os.fsync(output.fileno())
+                state["output_offset"] = output.tell()
+        self.state = state
+        with open(self.path + ".tmp", "w") as h:
+            json.dump(state, h)
+            h.flush()
+            os.fsync(h.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def open_output(self, path, resume=False):
+        """
+        Opens the output file. When resuming, anything written after the last
+        checkpoint is truncated and new records are appended from there.
+        """
+        if resume and "output_offset" in self.state and os.path.exists(path):
+            h = open(path, "r+")
+            h.truncate(self.state["output_offset"])
+            h.seek(self.state["output_offset"])
+            _log.info(f"resuming {path} from byte {self.state['output_offset']}, "
+                      f"{self.state.get('emitted', 0)} records already written")
+            return h
+        return open(path, "w")
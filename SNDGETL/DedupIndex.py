@@ -0,0 +1,97 @@
+import sqlite3
+import datetime
+import logging
+import itertools
+
+from SNDGETL.StateStore import StateStore
+
+_log = logging.getLogger(__name__)
+
+
+class DedupIndex:
+    """
+    Persistent index of the records already delivered by any run, keyed by
+    (source, id) with a hash of their content. source is a namespace such as
+    "europmc", an EBI search domain or an accession category.
+
+    contains / changed answer batch lookups, filter drops the known and
+    unchanged records from a stream. New hashes are only stored by commit(),
+    call it once the output has been written.
+    """
+    LOOKUP_BATCH = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS records (
+                                source TEXT, id TEXT, digest TEXT, first_seen TEXT, last_seen TEXT,
+                                PRIMARY KEY (source, id)) WITHOUT ROWID""")
+        self._db.commit()
+        self.skipped = 0
+
+    def _digests(self, source, ids):
+        found = {}
+        ids = list(ids)
+        for start in range(0, len(ids), DedupIndex.LOOKUP_BATCH):
+            chunk = ids[start:start + DedupIndex.LOOKUP_BATCH]
+            rows = self._db.execute(f"SELECT id, digest FROM records WHERE source = ? AND id IN "
+                                    f"({','.join('?' * len(chunk))})", [source] + chunk)
+            found.update(rows)
+        return found
+
+    def contains(self, source, ids):
+        """the subset of ids already in the index"""
+        return set(self._digests(source, ids))
+
+    def changed(self, source, digests):
+        """digests: {id: digest}. Returns the ids that are new or whose digest is different"""
+        known = self._digests(source, digests)
+        return {rid for rid, digest in digests.items() if known.get(rid) != digest}
+
+    def add(self, source, digests):
+        now = datetime.datetime.now().isoformat()
+        self._db.executemany("""INSERT INTO records VALUES (?, ?, ?, ?, ?)
+                                ON CONFLICT (source, id) DO UPDATE SET digest = excluded.digest,
+                                                                       last_seen = excluded.last_seen""",
+                             [(source, rid, digest, now, now) for rid, digest in digests.items()])
+
+    def filter(self, source, items, id_func, digest_func, batch_size=LOOKUP_BATCH):
+        """
+        Yields the items whose id is not in the index or whose digest changed,
+        looking them up batch_size at a time. Repeated ids inside the stream are
+        also dropped.
+        """
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                return
+            digests = {}
+            for item in batch:
+                digests[str(id_func(item))] = digest_func(item)
+            changed = self.changed(source, digests)
+            self.add(source, {rid: digests[rid] for rid in changed})
+            for item in batch:
+                rid = str(id_func(item))
+                if rid in changed:
+                    changed.discard(rid)
+                    yield item
+                else:
+                    self.skipped += 1
+
+    def filter_results(self, source, results, id_func=lambda doc: doc["id"], ignore_fields=(),
+                       batch_size=LOOKUP_BATCH):
+        """
+        filter for the [doc, total, idx] results of the client queries. Use
+        batch_size=1 with a Checkpoint, otherwise a page could be checkpointed
+        while some of its records are still waiting in the batch.
+        """
+        return self.filter(source, results, lambda result: id_func(result[0]),
+                           lambda result: StateStore.digest(result[0], ignore_fields), batch_size=batch_size)
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
@@ -1,6 +1,13 @@
+import os
 import logging
 
 from SNDGETL import init_log
+from SNDGETL.AccessionIndex import AccessionIndex
+from SNDGETL.CSVSink import CSVSink
+from SNDGETL.DedupIndex import DedupIndex
+from SNDGETL.JSONLines import detect_compression, loads, open_file
+from SNDGETL.Metrics import metrics
+from SNDGETL.ParquetSink import ParquetSink
 
 _log = logging.getLogger(__name__)
 
@@ -61,22 +68,48 @@ class EBIAccessionExtractor(object):
         PUBLICATION_DEFAULT_DS: "publications.csv"
     }
 
-    def __init__(self, workdir, type_file_map=DEFAULT_TYPE_FILE_MAP):
+    def __init__(self, workdir, type_file_map=DEFAULT_TYPE_FILE_MAP, dedup="exact",
+                 bloom_capacity=CSVSink.DEFAULT_BLOOM_CAPACITY, max_bytes=None, output_format="csv",
+                 dedup_index=None, index=None):
+        """
+        dedup_index: DedupIndex to skip the accessions written by previous runs
+        index: AccessionIndex where the accession - publication links are added
+        """
         self.workdir = workdir
+        self.dedup_index = dedup_index
+        self.index = index
+        self.output_format = output_format
         self.type_file_map = type_file_map
+        self.dedup = dedup
+        self.bloom_capacity = bloom_capacity
+        self.max_bytes = max_bytes
         self.handler_map = {}
 
     def __enter__(self):
         for k, v in self.type_file_map.items():
-            self.handler_map[k] = open(self.workdir + "/" + v, "w")
+            if self.output_format == "parquet":
+                self.handler_map[k] = ParquetSink(self.workdir + "/" + os.path.splitext(v)[0] + ".parquet",
+                                                  "accession", dedup=self.dedup, bloom_capacity=self.bloom_capacity)
+            else:
+                self.handler_map[k] = CSVSink(self.workdir + "/" + v, dedup=self.dedup,
+                                              bloom_capacity=self.bloom_capacity, max_bytes=self.max_bytes)
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         for v in self.handler_map.values():
             v.close()
+        if self.dedup_index and exc_type is None:
+            self.dedup_index.commit()
+        if self.index and exc_type is None:
+            self.index.commit()
 
     def links_entry(self, data):
         assert self.handler_map, "object not initialized"
-        if data["Name"] in self.type_file_map:
+        yield from EBIAccessionExtractor.entry_links(data, self.type_file_map)
+
+    @staticmethod
+    def entry_links(data, type_file_map):
+        if data["Name"] in type_file_map:
             for sec in data["Section"]:
                 for link in sec["Linklist"]["Link"]:
                     yield (EBIAccessionExtractor.PUBLICATION_DEFAULT_DS, link["Source"]["Identifier"]["IDScheme"],
@@ -90,23 +123,134 @@ class EBIAccessionExtractor(object):
                         yield data["Name"], link["Target"]["Identifier"]["ID"], link["Target"]["Identifier"]["Title"]
                     """
 
-    def save_data(self, data):
-        for ds, scheme, rid, title in self.links_entry(data):
+    @staticmethod
+    def entry_rows(data, type_file_map):
+        for ds, scheme, rid, title in EBIAccessionExtractor.entry_links(data, type_file_map):
             if (ds == "Nucleotide Sequences") and (".." in rid):
                 continue
-            self.handler_map[ds].write(f'{scheme},{rid},"{title}"\n')
+            yield ds, scheme, rid, title
+
+    @staticmethod
+    def entry_index_links(data, type_file_map):
+        """(category, scheme, accession, title, publication scheme, publication id) of every accession row"""
+        links = EBIAccessionExtractor.entry_links(data, type_file_map)
+        # entry_links yields the publication row before each accession row
+        for (_, pub_scheme, pub_id, _), (ds, scheme, rid, title) in zip(links, links):
+            if (ds == "Nucleotide Sequences") and (".." in rid):
+                continue
+            yield ds, scheme, rid, title, pub_scheme, pub_id
+
+    def save_data(self, data):
+        assert self.handler_map, "object not initialized"
+        self.save_rows(EBIAccessionExtractor.entry_rows(data, self.type_file_map))
+        if self.index:
+            self.index.add(EBIAccessionExtractor.entry_index_links(data, self.type_file_map))
+
+    def save_rows(self, rows):
+        if self.dedup_index:
+            rows = self._new_rows(rows)
+        count = 0
+        with metrics.timer("write_seconds", stage="accessions"):
+            for ds, scheme, rid, title in rows:
+                self.handler_map[ds].write((scheme, rid, title))
+                count += 1
+        metrics.records("accessions", count)
+
+    def _new_rows(self, rows):
+        by_category = {}
+        for row in rows:
+            by_category.setdefault(row[0], []).append(row)
+        for ds, ds_rows in by_category.items():
+            yield from self.dedup_index.filter(ds, ds_rows, id_func=lambda row: f"{row[1]}:{row[2]}",
+                                               digest_func=lambda row: row[3])
+
+
+def line_aligned_ranges(path, chunk_size):
+    """Splits a file in (start, end) byte ranges of about chunk_size that begin and end at line boundaries"""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as h:
+        while bounds[-1] < size:
+            h.seek(min(bounds[-1] + chunk_size, size))
+            h.readline()
+            bounds.append(min(h.tell(), size))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _extract_range(task):
+    path, start, end, type_file_map, index_links, dedup = task
+    # repeated rows of the range are dropped here only when the sinks drop them too
+    rows = {} if dedup else []
+    links = {}
+    with open(path, "rb") as h:
+        h.seek(start)
+        while h.tell() < end:
+            line = h.readline()
+            if not line.strip():
+                continue
+            try:
+                data = loads(line)
+                if dedup:
+                    rows.update(dict.fromkeys(EBIAccessionExtractor.entry_rows(data, type_file_map)))
+                else:
+                    rows.extend(EBIAccessionExtractor.entry_rows(data, type_file_map))
+                if index_links:
+                    for link in EBIAccessionExtractor.entry_index_links(data, type_file_map):
+                        links[link] = None
+            except KeyError:
+                _log.error(line.decode())
+                raise
+    return list(rows), list(links)
+
+
+def parallel_extract(path, workers, type_file_map=EBIAccessionExtractor.DEFAULT_TYPE_FILE_MAP,
+                     chunk_size=32 * 1024 ** 2, index_links=False, dedup="exact"):
+    """
+    Parses a EuroPMCLinks json lines file in a process pool, one line aligned
+    byte range per task. Yields the (category, scheme, id, title) rows of each
+    range in file order, so writing them gives the same output as the serial
+    mode with the same dedup, with the AccessionIndex links of the range (empty
+    unless index_links).
+    """
+    import multiprocessing  # only the parallel mode needs it
+
+    chunk_size = max(min(chunk_size, os.path.getsize(path) // workers + 1), 1)
+    tasks = [(path, start, end, type_file_map, index_links, dedup)
+             for start, end in line_aligned_ranges(path, chunk_size)]
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap(_extract_range, tasks)
 
 
 if __name__ == "__main__":
-    import os
     import argparse
     import json
 
+    from SNDGETL.Metrics import add_metrics_args, metrics_from_args
+
     parser = argparse.ArgumentParser(description='extracts ids from EuroPMCLinks script')
 
-    parser.add_argument('json_load', action='store', help="json created by EuroPMCLinks script")
+    parser.add_argument('json_load', action='store',
+                        help="json created by EuroPMCLinks script, can be gzip / zstd compressed")
     parser.add_argument('workdir', action='store', help="dir to save the accession numbers")
 
+    parser.add_argument('--dedup', action='store', choices=["exact", "bloom", "none"], default="exact",
+                        help="drop repeated rows remembering all of them (exact) or with a bloom filter "
+                             "of --bloom_capacity rows per file, for huge inputs. Default: exact")
+    parser.add_argument('--bloom_capacity', action='store', type=int, default=CSVSink.DEFAULT_BLOOM_CAPACITY)
+    parser.add_argument('--max_file_size', action='store', type=int, default=None,
+                        help="splits every csv in numbered files of this many MB")
+
+    parser.add_argument('--format', action='store', choices=["csv", "parquet"], default="csv",
+                        help="parquet writes scheme/id/title columns to CATEGORY.parquet files, requires pyarrow")
+    parser.add_argument('--dedup_index', action='store', default=None,
+                        help="sqlite index shared by all the runs: accessions written before are skipped")
+    parser.add_argument('--workers', action='store', type=int, default=1,
+                        help="parse the input in N processes. Default 1")
+    parser.add_argument('--index', action='store', default=None,
+                        help="sqlite accession - publication index updated with the links of every run, "
+                             "see SNDGETL.AccessionIndex")
+    add_metrics_args(parser)
+
     parser.add_argument('-v', '--verbose', action="store_true")
     parser.add_argument('-s', '--silent', action="store_true")
 
@@ -120,18 +264,38 @@ if __name__ == "__main__":
         _log.disabled = True
 
     init_log(rootloglevel=logging.DEBUG if args.verbose else logging.INFO)
+    metrics_from_args(args)
 
     if not os.path.exists(args.workdir):
         os.makedirs(args.workdir)
     assert os.path.exists(args.workdir), f"'{args.workdir}' could not be created"
 
-    eae = EBIAccessionExtractor(args.workdir)
-    with eae, open(args.json_load) as h:
-        for l in h:
-            try:
-                data = json.loads(l)
-                eae.save_data(data)
-            except KeyError as ex:
-                _log.error(json.dumps(data, indent=2))
-                _log.error(ex)
-                raise
+    dedup = None if args.dedup == "none" else args.dedup
+    eae = EBIAccessionExtractor(args.workdir, dedup=dedup,
+                                bloom_capacity=args.bloom_capacity,
+                                max_bytes=args.max_file_size * 1024 ** 2 if args.max_file_size else None,
+                                output_format=args.format,
+                                dedup_index=DedupIndex(args.dedup_index) if args.dedup_index else None,
+                                index=AccessionIndex(args.index) if args.index else None)
+    if args.workers > 1 and detect_compression(args.json_load):
+        _log.warning("compressed inputs can not be split between workers, parsing it in a single process")
+        args.workers = 1
+
+    with eae:
+        if args.workers > 1:
+            for rows, links in parallel_extract(args.json_load, args.workers, eae.type_file_map,
+                                                index_links=eae.index is not None, dedup=dedup):
+                eae.save_rows(rows)
+                if eae.index:
+                    eae.index.add(links)
+        else:
+            with open_file(args.json_load) as h:
+                for l in h:
+                    try:
+                        with metrics.timer("parse_seconds", client="extract"):
+                            data = json.loads(l)
+                        eae.save_data(data)
+                    except KeyError as ex:
+                        _log.error(json.dumps(data, indent=2))
+                        _log.error(ex)
+                        raise
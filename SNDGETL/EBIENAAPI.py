@@ -3,48 +3,156 @@ https://europepmc.org/RestfulWebService#!/Europe32PMC32Articles32RESTful32API/da
 
 '''
 
-import requests
+import time
 import logging
-import xmltodict
+import xml.etree.ElementTree as ET
 
 from SNDGETL import init_log, ProcessingException
+from SNDGETL.Metrics import metrics
+from SNDGETL.ParallelFetcher import ParallelFetcher
+from SNDGETL.Transport import default_transport
 
 _log = logging.getLogger(__name__)
 
+# end of parse_set, element_to_dict gives None for an empty record
+_END = object()
+
+
+def element_to_dict(element):
+    """Same structure xmltodict builds: @attributes, #text and lists for repeated tags"""
+    data = {f"@{k}": v for k, v in element.attrib.items()}
+    for child in element:
+        value = element_to_dict(child)
+        if child.tag in data:
+            if not isinstance(data[child.tag], list):
+                data[child.tag] = [data[child.tag]]
+            data[child.tag].append(value)
+        else:
+            data[child.tag] = value
+    text = (element.text or "").strip()
+    if data:
+        if text:
+            data["#text"] = text
+        return data
+    return text or None
+
+
+def accession_batches(accessions, endpoint, batch_size):
+    """Groups any iterable of accessions in lists that fit batch_size and the url length limit"""
+    base_length = len(endpoint.format(accession=""))
+    batch = []
+    length = base_length
+    for accession in accessions:
+        accession = accession.strip()
+        if not accession:
+            continue
+        if batch and (len(batch) >= batch_size or length + len(accession) + 1 > EBIENAAPI.MAX_URL_LENGTH):
+            yield batch
+            batch = []
+            length = base_length
+        batch.append(accession)
+        length += len(accession) + 1
+    if batch:
+        yield batch
+
 
 class EBIENAAPI:
     DEFAULT_ENDPOINT = "https://www.ebi.ac.uk/ena/browser/api/xml/{accession}"
+    DEFAULT_BATCH_SIZE = 100
+    MAX_URL_LENGTH = 4000
 
-    def __init__(self, endpoint=DEFAULT_ENDPOINT):
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, session=None):
         self.endpoint = endpoint
+        self.session = session or default_transport()
 
     def query(self, accessions):
-        result = requests.get(self.endpoint.format(accession=",".join(accessions)))
-        if result.ok:
-            data = xmltodict.parse(result.text)["SAMPLE_SET"]
-            for samples in data.values():
-                for sample in samples:
-                    yield sample
-        else:
-            ex = ProcessingException("error in http request",
-                                     data=[self.endpoint, result.status_code, result.text])
-            logging.error("error executing page handler", exc_info=ex)
-            raise ex
+        """
+        Yields every record (SAMPLE, RUN, ...) of the xml set, parsed one at a
+        time while the response is downloaded (so parse_seconds also counts
+        the body download, not the time the records spend with the caller).
+        With a ResponseCache in the session the body is read whole to be
+        stored (or comes whole from the cache), so it is parsed from memory.
+        """
+        result = self.session.get(self.endpoint.format(accession=",".join(accessions)), stream=True)
+        with result:
+            if result.ok:
+                if hasattr(result.raw, "decode_content"):
+                    result.raw.decode_content = True
+                records = EBIENAAPI.parse_set(result.raw)
+                elapsed = 0
+                while True:
+                    start = time.perf_counter()
+                    record = next(records, _END)
+                    elapsed += time.perf_counter() - start
+                    if record is _END:
+                        break
+                    yield record
+                metrics.observe("parse_seconds", elapsed, client="ena")
+            else:
+                ex = ProcessingException("error in http request",
+                                         data=[self.endpoint, result.status_code, result.text])
+                logging.error("error executing page handler", exc_info=ex)
+                raise ex
+
+    @staticmethod
+    def parse_set(stream):
+        depth = 0
+        root = None
+        for event, element in ET.iterparse(stream, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = element
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 1:
+                    yield element_to_dict(element)
+                    root.clear()
+
+    def batches(self, accessions, batch_size=DEFAULT_BATCH_SIZE):
+        return accession_batches(accessions, self.endpoint, batch_size)
+
+    def query_batched(self, accessions, batch_size=DEFAULT_BATCH_SIZE, workers=4, ordered=True):
+        """
+        Resolves any number of accessions: they are split in batches that are
+        requested concurrently, so only max in flight batches are in memory.
+        Each batch is parsed to a list of records before it is yielded, memory
+        grows with batch_size times the in flight batches, not with the input.
+        Yields (batch, records, exception) per batch, failed batches come with records=None.
+        """
+        fetcher = ParallelFetcher(workers=workers, ordered=ordered)
+        yield from fetcher.map(lambda batch: list(self.query(batch)), self.batches(accessions, batch_size))
 
 
 if __name__ == "__main__":
     import os
     import json
     import argparse
+    import itertools
     import sys
 
+    from SNDGETL.JSONLines import add_compression_args, open_file
+    from SNDGETL.Metrics import add_metrics_args, metrics_from_args
+    from SNDGETL.Transport import add_transport_args, transport_from_args
+
     parser = argparse.ArgumentParser(description='Gets samples from accessions')
 
-    parser.add_argument('accessions', action='store', help="pmcid", nargs="+")
+    parser.add_argument('accessions', action='store', help="accessions", nargs="*")
+    parser.add_argument('--file', action='store', default=None,
+                        help="file with one accession per line, - for stdin. Can be gzip / zstd compressed")
+    parser.add_argument('-o', '--output', action='store', default=None,
+                        help="file to write the records to. Default: stdout")
 
     parser.add_argument('--ebipmc_endpoint', action='store', type=str,
                         default=os.environ.get("EBIPMC_ENDPOINT", EBIENAAPI.DEFAULT_ENDPOINT),
                         help=f"default: {EBIENAAPI.DEFAULT_ENDPOINT}")
+    parser.add_argument('--batch_size', action='store', type=int, default=EBIENAAPI.DEFAULT_BATCH_SIZE,
+                        help=f"accessions per request. Default: {EBIENAAPI.DEFAULT_BATCH_SIZE}")
+    parser.add_argument('--workers', action='store', type=int, default=4,
+                        help="concurrent requests. Default 4")
+    add_transport_args(parser)
+    add_metrics_args(parser)
+    add_compression_args(parser)
 
     parser.add_argument('-v', '--verbose', action="store_true")
     parser.add_argument('-s', '--silent', action="store_true")
@@ -59,7 +167,23 @@ if __name__ == "__main__":
         _log.disabled = True
 
     init_log(rootloglevel=logging.DEBUG if args.verbose else logging.INFO)
-
-    api = EBIENAAPI(args.ebipmc_endpoint)
-    for x in api.query(args.accessions):
-        sys.stdout.write(json.dumps(x) + "\n")
+    metrics_from_args(args)
+
+    if not args.accessions and not args.file:
+        parser.error("no accessions, use the positional arguments or --file")
+
+    accessions = args.accessions
+    if args.file:
+        accessions = itertools.chain(accessions, open_file(args.file))
+
+    api = EBIENAAPI(args.ebipmc_endpoint, session=transport_from_args(args, min_pool_size=args.workers))
+    with open_file(args.output or "-", "w", compression=args.compression) as output:
+        for batch, records, ex in api.query_batched(accessions, batch_size=args.batch_size, workers=args.workers):
+            if ex:
+                sys.stderr.write(f"error processing: {','.join(batch)}\n")
+                sys.stderr.write("\n")
+                continue
+            with metrics.timer("write_seconds", stage="ena"):
+                for x in records:
+                    output.write(json.dumps(x) + "\n")
+            metrics.records("ena", len(records))
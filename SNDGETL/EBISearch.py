@@ -1,14 +1,17 @@
 import math
 import sys
+import datetime
 
 '''
 https://www.ebi.ac.uk/ebisearch/documentation/rest-api
 https://www.ebi.ac.uk/ebisearch/metadata.ebi?db=sra-sample
 '''
-import requests
 import logging
 
 from SNDGETL import init_log, ProcessingException
+from SNDGETL.Metrics import metrics
+from SNDGETL.ParallelFetcher import ParallelFetcher
+from SNDGETL.Transport import default_transport
 
 _log = logging.getLogger(__name__)
 
@@ -17,57 +20,140 @@ class EBISearch:
     DEFAULT_ENDPOINT = "https://www.ebi.ac.uk/ebisearch/ws/rest/"
     DEFAULT_DB = "sra-sample"
 
-    def __init__(self, domain=DEFAULT_DB, endpoint=DEFAULT_ENDPOINT, page_size=100):
+    def __init__(self, domain=DEFAULT_DB, endpoint=DEFAULT_ENDPOINT, page_size=100, session=None, fields=None):
         self.endpoint = endpoint
+        self.fields = fields
+        self.session = session or default_transport()
         self.domain = domain
         self.page_size = page_size
         self.queryParams = None
         self.total = None
 
-    def query(self, query, start=0):
+    def query(self, query, start=0, on_page=None):
+        """
+        Yields [doc, total, idx] for every entry from the start offset on.
+        on_page(next_start) is called once all the entries of a page have been consumed.
+        """
         self.queryParams = {"query": query, "size": self.page_size, "start": start}
         initial_curr_page = start
         logging.debug(f'initial_curr_page: {initial_curr_page}')
         data = self._query()
-        for idx, doc in enumerate(data, 1):
+        for idx, doc in enumerate(data or [], start + 1):
             yield [doc, self.total, idx]
-        for page in range(1, math.ceil(self.total / self.page_size)):
+        if on_page:
+            on_page(self.queryParams["start"])
+        for page in range(1, math.ceil((self.total - start) / self.page_size)):
+            offset = self.queryParams["start"]
             data = self._query()
-            for idx, doc in enumerate(data, self.page_size + 1):
+            for idx, doc in enumerate(data or [], offset + 1):
+                yield [doc, self.total, idx]
+            if on_page:
+                on_page(self.queryParams["start"])
+
+    def query_sharded(self, queries, workers=4, max_in_flight=None):
+        """
+        Parallel version of query. queries is one query or a list of disjoint
+        queries (ex: the date_windows of a query). The first page of each one
+        gives its hitCount, then the remaining pages are fetched concurrently as
+        independent offset ranges and merged back in order. Entries that show up
+        twice (results shifting between requests, overlapping queries) are skipped.
+        Yields [doc, total, idx] like query.
+        """
+        if isinstance(queries, str):
+            queries = [queries]
+        fetcher = ParallelFetcher(workers=workers, max_in_flight=max_in_flight or workers * 2, ordered=True)
+
+        first_pages = []
+        for (query, _), data, ex in fetcher.map(lambda task: self._fetch(*task), [(q, 0) for q in queries]):
+            if ex:
+                raise ex
+            first_pages.append((query, data))
+        self.total = sum(int(data["hitCount"]) for _, data in first_pages)
+
+        seen = set()
+        idx = 0
+
+        def new_entries(data):
+            for doc in data.get("entries") or []:
+                key = (doc.get("source"), doc.get("id"))
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield doc
+
+        for _, data in first_pages:
+            for doc in new_entries(data):
+                idx += 1
+                yield [doc, self.total, idx]
+
+        tasks = [(query, offset) for query, data in first_pages
+                 for offset in range(self.page_size, int(data["hitCount"]), self.page_size)]
+        for task, data, ex in fetcher.map(lambda task: self._fetch(*task), tasks):
+            if ex:
+                raise ex
+            for doc in new_entries(data):
+                idx += 1
                 yield [doc, self.total, idx]
 
     def _query(self):
+        data = self._fetch(self.queryParams["query"], self.queryParams["start"])
+        self.queryParams["start"] = self.queryParams["start"] + self.queryParams["size"]
+        logging.debug(f'offset: {self.queryParams["start"]}')
+        self.total = int(data["hitCount"])
+        try:
+            x = data["entries"]
+            return x
+        except:
+            print(data)
+            return None
+
+    def _fetch(self, query, start):
         headers = {'Accept': 'application/json'}
-        result = requests.get(self.endpoint + self.domain, self.queryParams,headers=headers)
+        params = {"query": query, "size": self.page_size, "start": start}
+        if self.fields:
+            params["fields"] = ",".join(self.fields)
+        result = self.session.get(self.endpoint + self.domain, params=params, headers=headers)
 
         if result.ok:
             try:
-                data = result.json()
+                with metrics.timer("parse_seconds", client="ebisearch"):
+                    return result.json()
             except:
                 logging.debug(result.text)
                 raise
-            self.queryParams["start"] = self.queryParams["start"] + self.queryParams["size"]
-            logging.debug(f'offset: {self.queryParams["start"]}')
-            self.total = int(data["hitCount"])
-            try:
-                x = data["entries"]
-                return x
-            except:
-                print(result)
-                return None
         else:
             ex = ProcessingException("error in http request",
-                                     data=[self.endpoint, self.queryParams, result.status_code, result.text])
+                                     data=[self.endpoint, params, result.status_code, result.text])
             logging.error("error executing page handler", exc_info=ex)
             raise ex
 
 
+def date_windows(fromdate, todate, windows):
+    """Splits [fromdate, todate] in consecutive non overlapping (from, to) date ranges"""
+    days = (todate - fromdate).days + 1
+    step = max(math.ceil(days / windows), 1)
+    ranges = []
+    start = fromdate
+    while start <= todate:
+        end = min(start + datetime.timedelta(days=step - 1), todate)
+        ranges.append((start, end))
+        start = end + datetime.timedelta(days=1)
+    return ranges
+
+
 if __name__ == "__main__":
     import os
     import json
     import argparse
     from tqdm import tqdm
-    import datetime
+
+    from SNDGETL.Checkpoint import Checkpoint
+    from SNDGETL.DedupIndex import DedupIndex
+    from SNDGETL.JSONLines import add_compression_args, compression_for, open_file
+    from SNDGETL.Metrics import add_metrics_args, metrics_from_args
+    from SNDGETL.ParquetSink import ParquetSink
+    from SNDGETL.StateStore import StateStore, parse_date
+    from SNDGETL.Transport import add_transport_args, transport_from_args
 
     parser = argparse.ArgumentParser(description='Retreives EBI data entries')
 
@@ -79,6 +165,28 @@ if __name__ == "__main__":
                         default=500)
 
     parser.add_argument('--offset', action='store', type=int, default=None)
+    parser.add_argument('--workers', action='store', type=int, default=1,
+                        help="concurrent page requests. Default 1 (serial)")
+    parser.add_argument('-o', '--output', action='store', default=None,
+                        help="file to write the results to. Default: stdout")
+    parser.add_argument('--format', action='store', choices=["jsonl", "parquet"], default="jsonl",
+                        help="parquet writes the sample columns in row groups, requires --output and pyarrow")
+    parser.add_argument('--checkpoint', action='store', default=None,
+                        help="state file updated after every page. Default: OUTPUT.checkpoint")
+    parser.add_argument('--resume', action="store_true",
+                        help="continue an interrupted harvest from its checkpoint, requires --output")
+    parser.add_argument('--state', action='store', default=None,
+                        help="sqlite file for incremental harvests: the date range starts at the last "
+                             "first_public_date seen and only new or changed entries are written")
+    parser.add_argument('--overlap_days', action='store', type=int, default=7,
+                        help="days before the last seen first_public_date that are queried again "
+                             "in incremental harvests. Default 7")
+    parser.add_argument('--dedup_index', action='store', default=None,
+                        help="sqlite index shared by all the runs: records already delivered with the same "
+                             "content are skipped")
+    add_transport_args(parser)
+    add_metrics_args(parser)
+    add_compression_args(parser)
 
     parser.add_argument('-v', '--verbose', action="store_true")
     parser.add_argument('-s', '--silent', action="store_true")
@@ -95,7 +203,9 @@ if __name__ == "__main__":
     aff_subparser.add_argument('country', action="store", help="sample country")
     aff_subparser.add_argument('--fromdate', action='store', help="ISO FORMAT: %Y-%m-%d",
                                type=datetime.date.fromisoformat, default=None)
-
+    aff_subparser.add_argument('--windows', action='store', type=int, default=1,
+                               help="splits the first_public_date range in N queries that are "
+                                    "harvested concurrently. Requires --fromdate")
 
 
     args = parser.parse_args()
@@ -108,18 +218,29 @@ if __name__ == "__main__":
         _log.disabled = True
 
     init_log(rootloglevel=logging.DEBUG if args.verbose else logging.INFO)
+    metrics_from_args(args)
 
     params = {"format": "json"}
     if args.offset:
         params["offSet"] = args.offset
 
 
+    state = StateStore(args.state) if args.state else None
+    fields = None
+
     if args.command == "query":
         query = args.ebi_query
         domain = args.domain
+        query_key = f"{domain}:{query}"
     elif args.command == "country":
         domain = "sra-sample"
         query = f"country:{args.country.strip()}"
+        query_key = f"{domain}:{query}"
+        if state:
+            fields = ["first_public_date"]
+            if not args.fromdate and state.watermark(query_key):
+                args.fromdate = state.watermark(query_key) - datetime.timedelta(days=args.overlap_days)
+                _log.info(f"incremental harvest from {args.fromdate}")
         if args.fromdate:
             fromdate = args.fromdate.strftime('%Y-%m-%d')
             todate = datetime.datetime.now()
@@ -129,11 +250,74 @@ if __name__ == "__main__":
             query = query + f" AND first_public_date:[{fromdate} TO {todate}]"
 
 
-    _log.debug(domain + "?" + query)
-
-    api = EBISearch(domain, args.ebipmc_endpoint,page_size=args.page_size)
-
-    with tqdm(api.query(query)) as pbar:
+    queries = [query]
+    if args.command == "country" and args.windows > 1:
+        if not args.fromdate:
+            parser.error("--windows requires --fromdate")
+        windows = date_windows(args.fromdate, datetime.date.today(), args.windows)
+        # no windows for a --fromdate after today, the single query already covers it
+        if windows:
+            # the last window keeps the far away end date, see the todate comment above
+            windows[-1] = (windows[-1][0], todate)
+            queries = [f"country:{args.country.strip()} AND first_public_date:[{wfrom} TO {wto}]"
+                       for wfrom, wto in windows]
+
+    _log.debug(domain + "?" + " | ".join(queries))
+
+    api = EBISearch(domain, args.ebipmc_endpoint, page_size=args.page_size,
+                    session=transport_from_args(args, min_pool_size=args.workers), fields=fields)
+
+    sharded = args.workers > 1 or len(queries) > 1
+    output = sys.stdout
+    checkpoint = None
+    sink = None
+    start = args.offset or 0
+    emitted = 0
+    if args.format == "parquet":
+        if not args.output or args.resume:
+            parser.error("parquet output requires --output and can not be resumed")
+        sink = ParquetSink(args.output, "sample")
+    elif args.output and compression_for(args.output, args.compression):
+        if args.resume:
+            parser.error("compressed outputs can not be resumed")
+        output = open_file(args.output, "w", compression=args.compression)
+    elif args.output:
+        checkpoint = Checkpoint(args.checkpoint or args.output + ".checkpoint")
+        if args.resume and sharded:
+            parser.error("--resume only works with --workers 1 and a single window")
+        if args.resume and checkpoint.state:
+            if checkpoint.state["query"] != query:
+                parser.error(f"the checkpoint is for another query: {checkpoint.state['query']}")
+            if checkpoint.state["done"]:
+                _log.info("the checkpoint says the harvest is already complete")
+                sys.exit(0)
+            start = checkpoint.state["start"]
+            emitted = checkpoint.state["emitted"]
+        output = checkpoint.open_output(args.output, resume=args.resume and bool(checkpoint.state))
+    elif args.resume:
+        parser.error("--resume requires --output")
+    elif compression_for("-", args.compression):
+        output = open_file("-", "w", compression=args.compression)
+
+    def save_checkpoint(next_start):
+        if checkpoint:
+            checkpoint.save(output=output, query=query, start=next_start, emitted=emitted,
+                            done=next_start >= api.total)
+
+    if sharded:
+        results = api.query_sharded(queries, workers=args.workers)
+    else:
+        results = api.query(query, start=start, on_page=save_checkpoint)
+    if state:
+        results = state.delta(query_key, results, id_func=lambda doc: f'{doc["source"]}:{doc["id"]}',
+                              date_func=lambda doc: parse_date((doc.get("fields", {}).get("first_public_date")
+                                                                or [None])[0]))
+    dedup_index = DedupIndex(args.dedup_index) if args.dedup_index else None
+    if dedup_index:
+        results = dedup_index.filter_results(domain, results, id_func=lambda doc: doc["id"],
+                                             batch_size=1 if checkpoint else DedupIndex.LOOKUP_BATCH)
+
+    with output, tqdm(results) as pbar:
         for qresult, totalPages, qcurr_page in pbar:
 
             if not pbar.total:
@@ -142,4 +326,19 @@ if __name__ == "__main__":
                 pbar.update(qcurr_page)
                 pbar.refresh()
 
-            print(json.dumps(qresult))
+            with metrics.timer("write_seconds", stage="ebisearch"):
+                if sink:
+                    sink.write_record(qresult)
+                else:
+                    output.write(json.dumps(qresult) + "\n")
+            metrics.records("ebisearch")
+            emitted += 1
+
+    if sink:
+        sink.close()
+
+    if state:
+        state.commit()
+    if dedup_index:
+        dedup_index.commit()
+        _log.info(f"{dedup_index.skipped} records skipped, already in {args.dedup_index}")
@@ -1,5 +1,6 @@
 import math
 import sys
+import datetime
 
 '''
 http://europepmc.org/docs/EBI_Europe_PMC_Web_Service_Reference.pdf
@@ -8,47 +9,118 @@ https://dev.elsevier.com/sc_search_views.html
 (FIRST_PDATE:[2018-07-04 TO 2026-12-31])
 sort_date:y
 '''
-import requests
 import logging
 
 from SNDGETL import init_log, ProcessingException
+from SNDGETL.Metrics import metrics
+from SNDGETL.ParallelFetcher import prefetch as background_prefetch
+from SNDGETL.Transport import default_transport
 
 _log = logging.getLogger(__name__)
 
 
 class EuroPMC:
     DEFAULT_ENDPOINT = "https://www.ebi.ac.uk/europepmc/webservices/rest/search"
+    # fields that change without the publication changing, ignored when comparing versions of a record
+    VOLATILE_FIELDS = ("citedByCount",)
+    MAX_PAGE_SIZE = 1000
+    # fields of each resultType, from the cheapest to the full record (core has everything)
+    RESULT_TYPE_FIELDS = {
+        "idlist": ("id", "source", "pmid", "pmcid", "doi"),
+        "lite": ("id", "source", "pmid", "pmcid", "doi", "title", "authorString", "journalTitle", "issue",
+                 "journalVolume", "pubYear", "journalIssn", "pageInfo", "pubType", "isOpenAccess", "inEPMC",
+                 "inPMC", "hasPDF", "hasBook", "hasSuppl", "citedByCount", "hasReferences", "hasTextMinedTerms",
+                 "hasDbCrossReferences", "hasLabsLinks", "hasTMAccessionNumbers", "firstIndexDate",
+                 "firstPublicationDate"),
+    }
+    # what the EuroPMCLinks step reads from each publication
+    LINK_FIELDS = ("id", "source", "pmid")
 
-    def __init__(self, endpoint=DEFAULT_ENDPOINT):
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, session=None):
         self.endpoint = endpoint
+        self.session = session or default_transport()
         self.queryParams = None
         self.total = None
         self.nextPageUrl = None
 
-    def query(self, query, pageSize=100, resultType="core", **queryParams):
+    def query(self, query, pageSize=100, resultType=None, prefetch=0, on_page=None, fields=None, **queryParams):
+        """
+        Yields [doc, total, position] for every result.
+        fields: only these keys are kept in each doc, and unless resultType is
+        given the cheapest resultType that has all of them is requested (see
+        result_type_for). Default: the full core records.
+        With prefetch > 0 up to that many pages are downloaded in a background
+        thread while the current one is consumed. The cursor makes the pages
+        sequential anyway, so more than 1 or 2 only helps with jittery responses.
+        on_page(page_number, nextPageUrl) is called once all the docs of a page
+        have been consumed, nextPageUrl and page (see pages) resume from there.
+        """
+        resultType = resultType or EuroPMC.result_type_for(fields)
+        pages = self.pages(query, pageSize=pageSize, resultType=resultType, **queryParams)
+        if prefetch:
+            pages = background_prefetch(pages, prefetch)
+        for curr_page, docs, next_page_url in pages:
+            for idx, doc in enumerate(docs, 1):
+                if fields:
+                    doc = EuroPMC.project(doc, fields)
+                yield [doc, self.total, curr_page * pageSize + idx]
+            if on_page:
+                on_page(curr_page, next_page_url)
+
+    def pages(self, query, pageSize=100, resultType="core", nextPageUrl=None, page=None, **queryParams):
+        """
+        Yields (page_number, docs, nextPageUrl) for every page of the query, following the cursor.
+        pageSize can not be over MAX_PAGE_SIZE.
+        A nextPageUrl from a previous run starts the harvest at that url, which is page number page.
+        """
         self.queryParams = {k: v for k, v in queryParams.items()}
+        if pageSize > EuroPMC.MAX_PAGE_SIZE:
+            raise ValueError(f"pageSize can not be over {EuroPMC.MAX_PAGE_SIZE}")
         self.queryParams.update({"query": query, "pageSize": pageSize, "resulttype": resultType})
-        initial_curr_page = queryParams.get("offSet", 0)
+        self.nextPageUrl = nextPageUrl
+        initial_curr_page = queryParams.get("offSet", 0) if page is None else page
         logging.debug(f'initial_curr_page: {initial_curr_page}')
-        for idx, doc in enumerate(self._query(), 1):
-            yield [doc, self.total, initial_curr_page * pageSize + idx]
-        # print("--------------------")
+        yield initial_curr_page, self._query() or [], self.nextPageUrl
 
         if self.nextPageUrl:
             rango = list(range(initial_curr_page + 1, math.ceil(self.total / pageSize)))
             for curr_page in rango:
                 assert self.nextPageUrl
-                for idx, doc in enumerate(self._query()):
-                    yield [doc, self.total, curr_page * pageSize + idx]
+                yield curr_page, self._query() or [], self.nextPageUrl
+
+    @staticmethod
+    def result_type_for(fields):
+        """cheapest resultType whose records have all the fields, core when fields is None"""
+        if fields:
+            for result_type, type_fields in EuroPMC.RESULT_TYPE_FIELDS.items():
+                if set(fields) <= set(type_fields):
+                    return result_type
+        return "core"
+
+    @staticmethod
+    def project(doc, fields):
+        return {field: doc[field] for field in fields if field in doc}
+
+    @staticmethod
+    def affiliation_query(affiliation, with_refs=True):
+        return f"AFF:{affiliation} AND HAS_XREFS:{'y' if with_refs else 'n'} AND sort_date:y"
+
+    @staticmethod
+    def date_range_query(query, fromdate):
+        todate = datetime.datetime.now()
+        # No funca la API si pones algunas fechas es raro. Por eso la fecha de fin de año
+        todate = datetime.date(todate.year + 3, 12, 31)
+        return query + f" AND FIRST_PDATE:[{fromdate.strftime('%Y-%m-%d')} TO {todate.strftime('%Y-%m-%d')}]"
 
     def _query(self):
         if self.nextPageUrl:
-            result = requests.get(self.nextPageUrl)
+            result = self.session.get(self.nextPageUrl)
         else:
-            result = requests.get(self.endpoint, self.queryParams)
+            result = self.session.get(self.endpoint, params=self.queryParams)
 
         if result.ok:
-            data = result.json()
+            with metrics.timer("parse_seconds", client="europmc"):
+                data = result.json()
             self.nextPageUrl = data.get("nextPageUrl", None)
             logging.debug(f'nextPageUrl: {self.nextPageUrl}')
             self.total = int(data["hitCount"])
@@ -70,19 +142,51 @@ if __name__ == "__main__":
     import json
     import argparse
     from tqdm import tqdm
-    import datetime
+
+    from SNDGETL.Checkpoint import Checkpoint
+    from SNDGETL.DedupIndex import DedupIndex
+    from SNDGETL.JSONLines import add_compression_args, compression_for, open_file
+    from SNDGETL.Metrics import add_metrics_args, metrics_from_args
+    from SNDGETL.ParquetSink import ParquetSink
+    from SNDGETL.StateStore import StateStore, parse_date
+    from SNDGETL.Transport import add_transport_args, transport_from_args
 
     parser = argparse.ArgumentParser(description='Detects active site from PDB of a given ligand')
 
     parser.add_argument('--ebipmc_endpoint', action='store', type=str,
                         default=os.environ.get("EBIPMC_ENDPOINT", EuroPMC.DEFAULT_ENDPOINT),
                         help=f"defauld: {EuroPMC.DEFAULT_ENDPOINT}")
-    parser.add_argument('--page_size', action='store', type=int,
-                        default=25)
-    parser.add_argument('--result_type', action='store', choices=["idlist", "lite", "core"],
-                        default="core")
+    parser.add_argument('--page_size', action='store', type=int, default=None,
+                        help=f"results per request, max {EuroPMC.MAX_PAGE_SIZE}. "
+                             f"Default: 25, or {EuroPMC.MAX_PAGE_SIZE} with --fields")
+    parser.add_argument('--result_type', action='store', choices=["idlist", "lite", "core"], default=None,
+                        help="Default: core, or the cheapest one with all the --fields")
+    parser.add_argument('--fields', action='store', default=None,
+                        help="comma separated fields to write (ex: id,source,pmid), the rest are dropped")
     parser.add_argument('--offset', action='store', type=int, default=None)
     parser.add_argument('--sort', action='store', type=str, default="P_PDATE_D ASC")
+    parser.add_argument('--prefetch', action='store', type=int, default=2,
+                        help="pages downloaded ahead while the current one is written. 0 = disabled. Default 2")
+    parser.add_argument('-o', '--output', action='store', default=None,
+                        help="file to write the results to. Default: stdout")
+    parser.add_argument('--format', action='store', choices=["jsonl", "parquet"], default="jsonl",
+                        help="parquet writes the publication columns in row groups, requires --output and pyarrow")
+    parser.add_argument('--checkpoint', action='store', default=None,
+                        help="state file updated after every page. Default: OUTPUT.checkpoint")
+    parser.add_argument('--resume', action="store_true",
+                        help="continue an interrupted harvest from its checkpoint, requires --output")
+    parser.add_argument('--state', action='store', default=None,
+                        help="sqlite file for incremental harvests: the date range starts at the last "
+                             "publication date seen and only new or changed records are written")
+    parser.add_argument('--overlap_days', action='store', type=int, default=7,
+                        help="days before the last seen publication date that are queried again "
+                             "in incremental harvests, for late indexed records. Default 7")
+    parser.add_argument('--dedup_index', action='store', default=None,
+                        help="sqlite index shared by all the runs: records already delivered with the same "
+                             "content are skipped")
+    add_transport_args(parser)
+    add_metrics_args(parser)
+    add_compression_args(parser)
 
     parser.add_argument('-v', '--verbose', action="store_true")
     parser.add_argument('-s', '--silent', action="store_true")
@@ -92,6 +196,8 @@ if __name__ == "__main__":
     query_subparser = subparsers.add_parser('query')
     query_subparser.add_argument('ebi_query', action='store',
                                  help="query to the EBI PMC Site", nargs="?")
+    query_subparser.add_argument('--fromdate', action='store', help="ISO FORMAT: %%Y-%%m-%%d",
+                                 type=datetime.date.fromisoformat, default=None)
 
     aff_subparser = subparsers.add_parser('affiliation')
 
@@ -114,8 +220,9 @@ if __name__ == "__main__":
         _log.disabled = True
 
     init_log(rootloglevel=logging.DEBUG if args.verbose else logging.INFO)
+    metrics_from_args(args)
 
-    api = EuroPMC(args.ebipmc_endpoint)
+    api = EuroPMC(args.ebipmc_endpoint, session=transport_from_args(args))
 
     params = {"format": "json"}
     if args.offset:
@@ -123,21 +230,78 @@ if __name__ == "__main__":
     if args.sort:
         params["sort"] = args.sort
 
+    state = StateStore(args.state) if args.state else None
+
+    fields = [field.strip() for field in args.fields.split(",")] if args.fields else None
+    if fields and (args.state or args.dedup_index):
+        # the incremental harvests identify the records by source:id and follow the publication date
+        fields += [field for field in ("id", "source", "firstPublicationDate") if field not in fields]
+    page_size = args.page_size or (EuroPMC.MAX_PAGE_SIZE if fields else 25)
+
     if args.command == "query":
         query = args.ebi_query
+        query_key = query
     elif args.command == "affiliation":
-        with_refs = "n" if args.no_refs else "y"
-        query = f"AFF:{args.affiliation} AND HAS_XREFS:{with_refs} AND sort_date:y"
-
-        if args.fromdate:
-            fromdate = args.fromdate.strftime('%Y-%m-%d')
-            todate = datetime.datetime.now()
-            # No funca la API si pones algunas fechas es raro. Por eso la fecha de fin de año
-            todate = datetime.date(todate.year + 3, 12, 31)
-            todate = todate.strftime('%Y-%m-%d')
-            query = query + f" AND FIRST_PDATE:[{fromdate} TO {todate}]"
+        query = EuroPMC.affiliation_query(args.affiliation, with_refs=not args.no_refs)
+        query_key = query
+
+    fromdate = args.fromdate
+    if state and not fromdate and state.watermark(query_key):
+        fromdate = state.watermark(query_key) - datetime.timedelta(days=args.overlap_days)
+        _log.info(f"incremental harvest from {fromdate}")
+    if fromdate:
+        # a free query can have OR terms, the date range applies to all of it
+        query = EuroPMC.date_range_query(query if args.command == "affiliation" else f"({query})", fromdate)
     _log.debug(query)
-    with tqdm(api.query(query, pageSize=args.page_size, **params)) as pbar:
+
+    output = sys.stdout
+    checkpoint = None
+    sink = None
+    resume = {}
+    emitted = 0
+    if args.format == "parquet":
+        if not args.output or args.resume:
+            parser.error("parquet output requires --output and can not be resumed")
+        sink = ParquetSink(args.output, "publication")
+    elif args.output and compression_for(args.output, args.compression):
+        if args.resume:
+            parser.error("compressed outputs can not be resumed")
+        output = open_file(args.output, "w", compression=args.compression)
+    elif args.output:
+        checkpoint = Checkpoint(args.checkpoint or args.output + ".checkpoint")
+        if args.resume and checkpoint.state:
+            if checkpoint.state["query"] != query:
+                parser.error(f"the checkpoint is for another query: {checkpoint.state['query']}")
+            if checkpoint.state["done"]:
+                _log.info("the checkpoint says the harvest is already complete")
+                sys.exit(0)
+            resume = {"nextPageUrl": checkpoint.state["nextPageUrl"], "page": checkpoint.state["page"]}
+            emitted = checkpoint.state["emitted"]
+        output = checkpoint.open_output(args.output, resume=bool(resume))
+    elif args.resume:
+        parser.error("--resume requires --output")
+    elif compression_for("-", args.compression):
+        output = open_file("-", "w", compression=args.compression)
+
+    def save_checkpoint(curr_page, next_page_url):
+        if checkpoint:
+            checkpoint.save(output=output, query=query, nextPageUrl=next_page_url, page=curr_page + 1,
+                            emitted=emitted, done=next_page_url is None)
+
+    results = api.query(query, pageSize=page_size, resultType=args.result_type, prefetch=args.prefetch,
+                        on_page=save_checkpoint, fields=fields, **resume, **params)
+    if state:
+        results = state.delta(query_key, results, id_func=lambda doc: f'{doc["source"]}:{doc["id"]}',
+                              date_func=lambda doc: parse_date(doc.get("firstPublicationDate")),
+                              ignore_fields=EuroPMC.VOLATILE_FIELDS)
+    dedup_index = DedupIndex(args.dedup_index) if args.dedup_index else None
+    if dedup_index:
+        results = dedup_index.filter_results("europmc", results,
+                                             id_func=lambda doc: f'{doc["source"]}:{doc["id"]}',
+                                             ignore_fields=EuroPMC.VOLATILE_FIELDS,
+                                             batch_size=1 if checkpoint else DedupIndex.LOOKUP_BATCH)
+
+    with output, tqdm(results) as pbar:
         for qresult, totalPages, qcurr_page in pbar:
 
             if not pbar.total:
@@ -146,4 +310,19 @@ if __name__ == "__main__":
                 pbar.update(qcurr_page)
                 pbar.refresh()
 
-            print(json.dumps(qresult))
+            with metrics.timer("write_seconds", stage="europmc"):
+                if sink:
+                    sink.write_record(qresult)
+                else:
+                    output.write(json.dumps(qresult) + "\n")
+            metrics.records("europmc")
+            emitted += 1
+
+    if sink:
+        sink.close()
+
+    if state:
+        state.commit()
+    if dedup_index:
+        dedup_index.commit()
+        _log.info(f"{dedup_index.skipped} records skipped, already in {args.dedup_index}")
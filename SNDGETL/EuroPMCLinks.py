@@ -3,10 +3,16 @@ https://europepmc.org/RestfulWebService#!/Europe32PMC32Articles32RESTful32API/da
 
 '''
 
-import requests
+import json
 import logging
 
+import requests
+
 from SNDGETL import init_log, ProcessingException
+from SNDGETL.EuroPMC import EuroPMC
+from SNDGETL.Metrics import metrics
+from SNDGETL.ParallelFetcher import ParallelFetcher, prefetch
+from SNDGETL.Transport import default_transport
 
 _log = logging.getLogger(__name__)
 
@@ -15,13 +21,15 @@ class EuroPMCLinks:
     DEFAULT_ENDPOINT = "https://www.ebi.ac.uk/europepmc/webservices/rest/{source}/{pmcid}/datalinks?format=json"
     DEFAULT_SOURCE = "MED"
 
-    def __init__(self, endpoint=DEFAULT_ENDPOINT):
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, session=None):
         self.endpoint = endpoint
+        self.session = session or default_transport()
 
     def query(self, source, pmcid):
-        result = requests.get(self.endpoint.format(source=source, pmcid=pmcid))
+        result = self.session.get(self.endpoint.format(source=source, pmcid=pmcid))
         if result.ok:
-            data = result.json()
+            with metrics.timer("parse_seconds", client="datalinks"):
+                data = result.json()
             if data["hitCount"] > 0:
                 return data["dataLinkList"]["Category"]
             else:
@@ -33,14 +41,121 @@ class EuroPMCLinks:
             logging.error("error executing page handler", exc_info=ex)
             raise ex
 
+    def query_many(self, source, pmcids, workers=8, max_in_flight=None, ordered=False, prefilter=None):
+        """
+        Concurrent version of query for a stream of ids, an id can also be a
+        (source, id) tuple to override the default source.
+        Yields (pmcid, categories, exception) as each request finishes, or in
+        input order when ordered=True. Failed ids come with categories=None.
+        With a LinksPrefilter, the ids it finds without links get [] without
+        a datalinks request.
+        """
+        items = prefilter.annotate(source, pmcids) if prefilter else ((pmcid, True) for pmcid in pmcids)
+
+        def query_item(item):
+            pmcid, has_links = item
+            if not has_links:
+                return []
+            return self.query(*pmcid) if isinstance(pmcid, tuple) else self.query(source, pmcid)
+
+        fetcher = ParallelFetcher(workers=workers, max_in_flight=max_in_flight, ordered=ordered)
+        for (pmcid, _), categories, ex in fetcher.map(query_item, items):
+            yield pmcid, categories, ex
+
+
+class LinksPrefilter:
+    """
+    Finds which articles have data links with one EuroPMC search per batch of
+    ids (SRC:MED AND (EXT_ID:1 OR EXT_ID:2 ...)) instead of a datalinks request
+    per article. The lite records say whether each article has database cross
+    references, labs links or text mined accessions (HAS_XREFS, HAS_LABSLINKS
+    and the accession numbers the datalinks service also returns); the others
+    have no links. Articles the search does not find are kept, to be safe,
+    and so are all the articles of a batch whose search failed.
+
+    When the session has a ResponseCache, the empty datalinks answers are
+    stored there, so the next runs (and EuroPMCLinks.query) get them from
+    the cache, and ids already cached skip the search.
+    """
+    DEFAULT_BATCH_SIZE = 100
+    LINK_FLAGS = ("hasDbCrossReferences", "hasLabsLinks", "hasTMAccessionNumbers")
+    EMPTY_RESPONSE = json.dumps({"hitCount": 0, "dataLinkList": {"Category": []}}).encode()
+
+    def __init__(self, links_api, search_endpoint=EuroPMC.DEFAULT_ENDPOINT, batch_size=DEFAULT_BATCH_SIZE):
+        self.links_api = links_api
+        self.europmc = EuroPMC(search_endpoint, session=links_api.session)
+        self.batch_size = batch_size
+        self.cache = getattr(links_api.session, "cache", None)
+        self.skipped = 0
+
+    def has_links(self, source, ids):
+        """{id: bool} for the ids of one source the search found"""
+        query = f"SRC:{source} AND ({' OR '.join(f'EXT_ID:{pmcid}' for pmcid in ids)})"
+        found = {}
+        for doc, _, _ in self.europmc.query(query, pageSize=min(len(ids), EuroPMC.MAX_PAGE_SIZE),
+                                            fields=("id", "source") + LinksPrefilter.LINK_FLAGS, format="json"):
+            found[doc["id"]] = any(doc.get(flag) == "Y" for flag in LinksPrefilter.LINK_FLAGS)
+        return found
+
+    def annotate(self, source, pmcids):
+        """Yields (pmcid, has_links) for every id, in the same order"""
+        return prefetch(self._annotate(source, pmcids), depth=2)
+
+    def _annotate(self, source, pmcids):
+        batch = []
+        for pmcid in pmcids:
+            batch.append(pmcid)
+            if len(batch) >= self.batch_size:
+                yield from self._annotate_batch(source, batch)
+                batch = []
+        if batch:
+            yield from self._annotate_batch(source, batch)
+
+    def _annotate_batch(self, source, batch):
+        by_source = {}
+        for pmcid in batch:
+            pmcid_source, pmcid_id = pmcid if isinstance(pmcid, tuple) else (source, pmcid)
+            if not self._cached(pmcid_source, pmcid_id):
+                by_source.setdefault(pmcid_source, []).append(pmcid_id)
+        found = {}
+        for pmcid_source, ids in by_source.items():
+            try:
+                source_found = self.has_links(pmcid_source, ids)
+            except (ProcessingException, requests.RequestException) as ex:
+                # the prefilter only saves requests, the datalinks of the batch are requested as usual
+                _log.warning(f"prefilter search of {len(ids)} {pmcid_source} ids failed: {ex}")
+                continue
+            for pmcid_id, has_links in source_found.items():
+                found[(pmcid_source, pmcid_id)] = has_links
+                if not has_links:
+                    self.skipped += 1
+                    self._cache_empty(pmcid_source, pmcid_id)
+        for pmcid in batch:
+            key = pmcid if isinstance(pmcid, tuple) else (source, pmcid)
+            yield pmcid, found.get(key, True)
+
+    def _url(self, source, pmcid):
+        return self.links_api.endpoint.format(source=source, pmcid=pmcid)
+
+    def _cached(self, source, pmcid):
+        return self.cache is not None and self.cache.get(self._url(source, pmcid)) is not None
+
+    def _cache_empty(self, source, pmcid):
+        if self.cache is not None:
+            self.cache.put(self._url(source, pmcid), LinksPrefilter.EMPTY_RESPONSE, "application/json")
+
 
 if __name__ == "__main__":
     import os
-    import json
     import argparse
     import sys
     from tqdm import tqdm
-    import pandas as pd
+
+    from SNDGETL.JSONLines import add_compression_args, iter_jsonl, open_file
+    from SNDGETL.Metrics import add_metrics_args, metrics_from_args
+    from SNDGETL.ParquetSink import ParquetSink
+
+    from SNDGETL.Transport import add_transport_args, transport_from_args
 
     parser = argparse.ArgumentParser(description='Gets related datasets from EUPMC article')
 
@@ -50,12 +165,32 @@ if __name__ == "__main__":
     query_subparser.add_argument('pmcid', action='store', help="from single pmcid")
     query_subparser = subparsers.add_parser('load_json')
     query_subparser.add_argument('json_file', action='store', help="from json generated by SNDG.EuroPMC")
+    query_subparser.add_argument('-o', '--output', action='store', default=None,
+                                 help="file to write the links to. Default: stdout")
+    query_subparser.add_argument('--format', action='store', choices=["jsonl", "parquet"], default="jsonl",
+                                 help="parquet writes one row per link, requires --output and pyarrow")
 
     parser.add_argument('--source', action='store', default=EuroPMCLinks.DEFAULT_SOURCE,
                         help="article's source. MED = Default")
     parser.add_argument('--ebipmc_endpoint', action='store', type=str,
                         default=os.environ.get("EBIPMC_ENDPOINT", EuroPMCLinks.DEFAULT_ENDPOINT),
                         help=f"defauld: {EuroPMCLinks.DEFAULT_ENDPOINT}")
+    parser.add_argument('--workers', action='store', type=int, default=1,
+                        help="concurrent requests in load_json mode. Default 1 (serial)")
+    parser.add_argument('--max_in_flight', action='store', type=int, default=None,
+                        help="max pending requests in load_json mode. Default: same as --workers")
+    parser.add_argument('--ordered', action="store_true",
+                        help="write load_json results in the same order as the input file")
+    parser.add_argument('--prefilter', action="store_true",
+                        help="in load_json mode, find the articles with links with batched EuroPMC searches "
+                             "and only request the datalinks of those")
+    parser.add_argument('--prefilter_batch', action='store', type=int, default=LinksPrefilter.DEFAULT_BATCH_SIZE,
+                        help=f"ids per prefilter search. Default {LinksPrefilter.DEFAULT_BATCH_SIZE}")
+    parser.add_argument('--search_endpoint', action='store', default=EuroPMC.DEFAULT_ENDPOINT,
+                        help=f"EuroPMC search used by --prefilter. Default: {EuroPMC.DEFAULT_ENDPOINT}")
+    add_transport_args(parser)
+    add_metrics_args(parser)
+    add_compression_args(parser)
     parser.add_argument('-v', '--verbose', action="store_true")
     parser.add_argument('-s', '--silent', action="store_true")
 
@@ -69,25 +204,46 @@ if __name__ == "__main__":
         _log.disabled = True
 
     init_log(rootloglevel=logging.DEBUG if args.verbose else logging.INFO)
+    metrics_from_args(args)
 
-    api = EuroPMCLinks(args.ebipmc_endpoint)
+    session = transport_from_args(args, min_pool_size=args.workers)
+    api = EuroPMCLinks(args.ebipmc_endpoint, session=session)
     if args.command == "single":
         sys.stdout.write(json.dumps(api.query(args.source, args.pmcid)))
     elif args.command == "load_json":
-        header = False
-        with open(args.json_file) as h:
-            if h.readline().startswith("#"):
-                header = True
-
-        with open(args.json_file) as h:
-            if header:
-                h.readline()
-            df = pd.read_json(h, lines=True)
-            for pmid in tqdm(df.pmid):
-                try:
-                    for record in api.query(args.source, pmid):
-                        json.dump(record, sys.stdout)
-                        sys.stdout.write("\n")
-                except Exception as ex:
-                    sys.stderr.write(f"error processing: {pmid}\n")
-                    sys.stderr.write("\n")
+        sink = None
+        output = sys.stdout
+        if args.format == "parquet":
+            if not args.output:
+                parser.error("parquet output requires --output")
+            sink = ParquetSink(args.output, "datalink")
+        elif args.output or args.compression:
+            output = open_file(args.output or "-", "w", compression=args.compression)
+
+        # articles without pmid (preprints, PMC only) are resolved with their own source and id
+        pmids = (pub["pmid"] or (pub["source"], pub["id"])
+                 for pub in iter_jsonl(args.json_file, fields=("pmid", "source", "id")))
+        prefilter = None
+        if args.prefilter:
+            prefilter = LinksPrefilter(api, args.search_endpoint, batch_size=args.prefilter_batch)
+        results = api.query_many(args.source, pmids, workers=args.workers,
+                                 max_in_flight=args.max_in_flight, ordered=args.ordered, prefilter=prefilter)
+        for pmid, records, ex in tqdm(results):
+            if ex:
+                sys.stderr.write(f"error processing: {pmid}\n")
+                sys.stderr.write("\n")
+                continue
+            with metrics.timer("write_seconds", stage="datalinks"):
+                for record in records:
+                    if sink:
+                        sink.write_record(record)
+                    else:
+                        json.dump(record, output)
+                        output.write("\n")
+            metrics.records("datalinks", len(records))
+        if sink:
+            sink.close()
+        if output is not sys.stdout:
+            output.close()
+        if prefilter:
+            _log.info(f"{prefilter.skipped} articles without links skipped by the prefilter")
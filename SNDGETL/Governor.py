@@ -0,0 +1,93 @@
+import time
+import random
+import logging
+import email.utils
+
+from SNDGETL.Metrics import metrics
+from SNDGETL.RateLimiter import RateLimiter
+
+_log = logging.getLogger(__name__)
+
+
+class Governor(RateLimiter):
+    """
+    Adaptive version of the RateLimiter that also retries failed requests.
+
+    Every host starts at `rate` requests per second (max_rate when None). Each
+    successful answer raises that rate by about `increase` req/s per second of
+    traffic, up to max_rate, and a throttling answer (429 / 503) halves it, at
+    most once per second and never below min_rate (AIMD), so long runs settle
+    around the highest rate the server accepts. A Retry-After header also
+    pauses the whole host for that long.
+
+    Connection errors and the RETRY_STATUS answers are retried up to `retries`
+    times, waiting Retry-After when the server sends it, or an exponential
+    backoff with jitter otherwise.
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    THROTTLE_STATUS = (429, 503)
+    DEFAULT_MAX_RATE = 50
+    DEFAULT_RETRIES = 5
+
+    def __init__(self, rate=None, max_rate=DEFAULT_MAX_RATE, min_rate=0.2, burst=1, increase=1.0,
+                 decrease=0.5, retries=DEFAULT_RETRIES, backoff=1.0, max_backoff=120):
+        super().__init__(rate=rate or max_rate, burst=burst)
+        self.max_rate = max(max_rate, self.rate)
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rates = {}
+        self._last_decrease = {}
+        self._paused_until = {}
+
+    def host_rate(self, host):
+        return self.rates.get(host, self.rate)
+
+    def reserve(self, host):
+        with self._lock:
+            paused = max(self._paused_until.get(host, 0) - time.monotonic(), 0)
+        return paused + super().reserve(host)
+
+    def record(self, host, response):
+        now = time.monotonic()
+        with self._lock:
+            rate = self.host_rate(host)
+            if response.status_code in Governor.THROTTLE_STATUS:
+                metrics.inc("throttled_total", host=host)
+                retry_after = Governor.retry_after(response)
+                if retry_after:
+                    self._paused_until[host] = max(self._paused_until.get(host, 0), now + retry_after)
+                if now - self._last_decrease.get(host, 0) >= 1:
+                    self._last_decrease[host] = now
+                    self.rates[host] = max(self.min_rate, rate * self.decrease)
+                    _log.info(f"{host} is throttling, rate down to {self.rates[host]:.2f} req/s")
+            elif response.ok:
+                self.rates[host] = min(self.max_rate, rate + self.increase / rate)
+
+    def retry_delay(self, attempt, response=None):
+        if attempt >= self.retries:
+            return None
+        if response is not None:
+            if response.status_code not in Governor.RETRY_STATUS:
+                return None
+            retry_after = Governor.retry_after(response)
+            if retry_after is not None:
+                return min(retry_after, self.max_backoff)
+        return random.uniform(0.5, 1.5) * min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    @staticmethod
+    def retry_after(response):
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
@@ -0,0 +1,152 @@
+import io
+import os
+import sys
+import gzip
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_log = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1024 ** 2
+EXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+MAGIC = {b"\x1f\x8b": "gzip", b"\x28\xb5\x2f\xfd": "zstd"}
+
+
+def compression_for(path, compression=None):
+    """gzip, zstd or None: the given one ("none" for plain files) or the one of the file extension"""
+    if compression:
+        return None if compression == "none" else compression
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def detect_compression(path):
+    """gzip, zstd or None from the first bytes of a file"""
+    with open(path, "rb") as h:
+        head = h.read(4)
+    return MAGIC.get(head) or MAGIC.get(head[:2])
+
+
+def add_compression_args(parser):
+    parser.add_argument('--compression', action='store', choices=["gzip", "zstd", "none"], default=None,
+                        help="compression of the json lines written, also to stdout. "
+                             "Default: from the output extension (.gz / .zst)")
+
+
+def open_file(path, mode="r", compression=None, level=None, threads=-1):
+    """
+    open() for plain, gzip and zstd files with 1MB buffers, - is stdin / stdout.
+    Writing, the compression is the given one or the one of the extension
+    (.gz / .zst). Reading, it is detected from the first bytes, so compressed
+    stdin works too. zstd requires the zstandard package and compresses in
+    `threads` threads (-1: one per cpu). Appending to a compressed file adds a
+    new gzip member / zstd frame, both are read back as one stream.
+    """
+    writing = mode[0] in "wa"
+    if path == "-":
+        raw = open((sys.stdout if writing else sys.stdin).fileno(), mode[0] + "b", buffering=BUFFER_SIZE,
+                   closefd=False)
+    else:
+        raw = open(path, mode[0] + "b", buffering=BUFFER_SIZE)
+
+    if writing:
+        compression = compression_for("" if path == "-" else path, compression)
+    elif compression is None:
+        compression = MAGIC.get(raw.peek(4)[:4]) or MAGIC.get(raw.peek(2)[:2])
+    elif compression == "none":
+        compression = None
+
+    if compression == "gzip":
+        stream = _Closing(gzip.GzipFile(fileobj=raw, mode=mode[0] + "b", compresslevel=level or 6), raw)
+    elif compression == "zstd":
+        if zstandard is None:
+            raw.close()
+            raise ImportError("zstd files require zstandard: pip install zstandard")
+        if writing:
+            cctx = zstandard.ZstdCompressor(level=level or 3, threads=threads)
+            stream = cctx.stream_writer(raw, closefd=path != "-")
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True,
+                                                                closefd=path != "-")
+    elif compression:
+        raw.close()
+        raise ValueError(f"unknown compression: {compression}")
+    else:
+        stream = raw
+    if compression:
+        stream = io.BufferedWriter(stream, BUFFER_SIZE) if writing else io.BufferedReader(stream, BUFFER_SIZE)
+
+    if "b" in mode:
+        return stream
+    return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+class _Closing(io.BufferedIOBase):
+    """a GzipFile that also closes the file object it was opened on"""
+
+    def __init__(self, stream, raw):
+        self.stream = stream
+        self.raw = raw
+
+    def readable(self):
+        return self.stream.readable()
+
+    def writable(self):
+        return self.stream.writable()
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def read1(self, size=-1):
+        return self.stream.read1(size)
+
+    def readinto(self, buffer):
+        return self.stream.readinto(buffer)
+
+    def write(self, data):
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+        self.raw.flush()
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.stream.close()
+            # stdin / stdout are opened with closefd=False, this only flushes them
+            self.raw.close()
+
+
+def loads(line):
+    """orjson when it is installed, it parses the large core records several times faster"""
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def iter_jsonl(path, fields=None):
+    """
+    Streams the records of a json lines file in one pass, skipping blank lines
+    and the # comment header written by the pipeline. With fields only those
+    keys are kept (missing ones as None), so big records are not retained.
+    A path of - reads stdin, gzip / zstd files are decompressed (see open_file).
+    """
+    with open_file(path, "rb") as h:
+        for line in h:
+            line = line.strip()
+            if not line or line.startswith(b"#"):
+                continue
+            record = loads(line)
+            if fields:
+                record = {field: record.get(field) for field in fields}
+            yield record
@@ -0,0 +1,212 @@
+import re
+import json
+import time
+import atexit
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+_log = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Cumulative bucket histogram, quantiles are interpolated inside the buckets"""
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                return round(lower + (upper - lower) * (rank - seen) / count, 6)
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "mean": round(self.sum / self.count, 6) if self.count else None,
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99),
+                "max": round(self.max, 6)}
+
+
+class Metrics:
+    """
+    Process wide counters, histograms and stage throughput of a run.
+
+    Transport times every request per endpoint (see endpoint_label) and counts
+    bytes, status codes, cache hits and retries, the Governor counts throttling
+    answers, the clients time the parsing of each response and the CLIs count
+    the records of each stage and the time spent writing them. Comparing
+    http_request_seconds, parse_seconds and write_seconds tells where a run
+    spends its time.
+
+    summary() / write_json() give a JSON friendly report and write_prometheus()
+    the same data in the Prometheus text format.
+    """
+    PREFIX = "sndgetl_"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.stages = {}
+
+    @staticmethod
+    def endpoint_label(url):
+        """host + path with the ids (path segments with digits or commas) replaced by {id}"""
+        parsed = urlparse(url)
+        path = "/".join("{id}" if re.search(r"[\d,]", segment) else segment
+                        for segment in parsed.path.split("/"))
+        return parsed.netloc + path
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def records(self, stage, count=1):
+        """Counts records going through a stage, for its records per second"""
+        now = time.time()
+        with self._lock:
+            current = self.stages.get(stage)
+            if current is None:
+                self.stages[stage] = [count, now, now]
+            else:
+                current[0] += count
+                current[2] = now
+
+    def request(self, url, seconds, status, nbytes=None, from_cache=False):
+        endpoint = Metrics.endpoint_label(url)
+        if from_cache:
+            self.inc("cache_hits_total", endpoint=endpoint)
+            return
+        self.observe("http_request_seconds", seconds, endpoint=endpoint)
+        self.inc("http_responses_total", status=str(status), endpoint=endpoint)
+        if nbytes:
+            self.inc("http_response_bytes_total", nbytes, endpoint=endpoint)
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters.clear()
+            self.histograms.clear()
+            self.stages.clear()
+
+    def summary(self):
+        now = time.time()
+        with self._lock:
+            report = {"elapsed": round(now - self.started, 3), "counters": {}, "histograms": {}, "stages": {}}
+            for (name, labels), value in sorted(self.counters.items()):
+                report["counters"].setdefault(name, []).append({**dict(labels), "value": value})
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                report["histograms"].setdefault(name, []).append({**dict(labels), **histogram.summary()})
+            for stage, (count, first, last) in sorted(self.stages.items()):
+                elapsed = max(last, first) - self.started
+                report["stages"][stage] = {"records": count, "seconds": round(elapsed, 3),
+                                           "records_per_second": round(count / elapsed, 2) if elapsed else None}
+        return report
+
+    def write_json(self, path):
+        with open(path, "w") as h:
+            json.dump(self.summary(), h, indent=2)
+
+    def prometheus(self):
+        def fmt(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {Metrics.PREFIX}{name} counter")
+                lines.append(f"{Metrics.PREFIX}{name}{fmt(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {Metrics.PREFIX}{name} histogram")
+                cumulative = 0
+                for le, count in zip([str(b) for b in histogram.buckets] + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{Metrics.PREFIX}{name}_bucket{fmt(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{Metrics.PREFIX}{name}_sum{fmt(labels)} {histogram.sum}")
+                lines.append(f"{Metrics.PREFIX}{name}_count{fmt(labels)} {histogram.count}")
+            if self.stages:
+                lines.append(f"# TYPE {Metrics.PREFIX}stage_records_total counter")
+                for stage, (count, _, _) in sorted(self.stages.items()):
+                    lines.append(f"{Metrics.PREFIX}stage_records_total{fmt((('stage', stage),))} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with open(path, "w") as h:
+            h.write(self.prometheus())
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+
+
+def add_metrics_args(parser):
+    parser.add_argument('--metrics', action='store', default=None,
+                        help="write a JSON summary of latencies, bytes, retries and throughput to this file at exit")
+    parser.add_argument('--prometheus', action='store', default=None,
+                        help="write the same metrics to this file in the Prometheus text format at exit")
+
+
+def metrics_from_args(args):
+    """Registers the at exit export of the process metrics asked in the command line"""
+
+    def export():
+        if args.metrics:
+            metrics.write_json(args.metrics)
+        if args.prometheus:
+            metrics.write_prometheus(args.prometheus)
+        for stage, data in metrics.summary()["stages"].items():
+            _log.info(f"{stage}: {data['records']} records, {data['records_per_second']} records/s")
+
+    if args.metrics or args.prometheus:
+        atexit.register(export)
+    return metrics
@@ -0,0 +1,100 @@
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+_log = logging.getLogger(__name__)
+
+
+class ParallelFetcher:
+    """
+    Runs a blocking function (usually an http request) over a stream of items
+    in a thread pool, keeping at most max_in_flight calls submitted at any time.
+
+    map() yields (item, result, exception) tuples as soon as each call finishes,
+    or in input order when ordered=True.
+    """
+
+    def __init__(self, workers=8, max_in_flight=None, ordered=False):
+        self.workers = workers
+        self.max_in_flight = max(max_in_flight or workers, 1)
+        self.ordered = ordered
+
+    @staticmethod
+    def _call(func, item):
+        try:
+            return item, func(item), None
+        except Exception as ex:
+            return item, None, ex
+
+    def map(self, func, items):
+        items = iter(items)
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            pending = deque()
+            for item in items:
+                pending.append(executor.submit(self._call, func, item))
+                if len(pending) >= self.max_in_flight:
+                    break
+
+            while pending:
+                if self.ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                for future in done:
+                    yield future.result()
+                for item in items:
+                    pending.append(executor.submit(self._call, func, item))
+                    if len(pending) >= self.max_in_flight:
+                        break
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+_END = object()
+
+
+def prefetch(iterable, depth=1):
+    """
+    Consumes iterable in a background thread, keeping at most depth items
+    ready for the caller, so producing the next items (ex: downloading the
+    next pages) overlaps with whatever the caller does with the current one.
+    Exceptions raised by the producer are raised again in the caller.
+    """
+    buffer = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except Exception as ex:
+            put((_END, ex))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, ex = buffer.get()
+            if ex:
+                raise ex
+            if item is _END:
+                return
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,155 @@
+import json
+import logging
+
+from SNDGETL.CSVSink import RowDedup
+
+_log = logging.getLogger(__name__)
+
+
+def _pyarrow():
+    """pyarrow is imported with the first parquet file, it is slower to import than the whole package"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("parquet output requires pyarrow: pip install pyarrow")
+    return pa, pq
+
+
+class RecordSchema:
+    """
+    Column names and arrow types of a kind of record, and the function that
+    turns one harvested record into rows (dicts) of those columns. Fields of
+    the record that have no column go as a json string to the `extra` column.
+    """
+
+    def __init__(self, name, fields, to_rows):
+        self.name = name
+        self.fields = fields
+        self.to_rows = to_rows
+
+    def arrow_schema(self):
+        pa, _ = _pyarrow()
+        return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in self.fields])
+
+
+def _with_extra(record, columns):
+    row = {column: record.get(column) for column in columns}
+    extra = {k: v for k, v in record.items() if k not in row}
+    row["extra"] = json.dumps(extra) if extra else None
+    return row
+
+
+PUBLICATION_FIELDS = [("id", "string"), ("source", "string"), ("pmid", "string"), ("pmcid", "string"),
+                      ("doi", "string"), ("title", "string"), ("authorString", "string"),
+                      ("journalTitle", "string"), ("pubYear", "string"), ("firstPublicationDate", "string"),
+                      ("isOpenAccess", "string"), ("citedByCount", "int64"), ("extra", "string")]
+
+SAMPLE_FIELDS = [("id", "string"), ("source", "string"), ("first_public_date", "string"), ("extra", "string")]
+
+DATALINK_FIELDS = [("category", "string"), ("obtained_by", "string"), ("source_scheme", "string"),
+                   ("source_id", "string"), ("target_scheme", "string"), ("target_id", "string"),
+                   ("target_title", "string")]
+
+ACCESSION_FIELDS = [("scheme", "string"), ("id", "string"), ("title", "string")]
+
+
+def publication_rows(record):
+    columns = [name for name, _ in PUBLICATION_FIELDS[:-1]]
+    yield _with_extra(record, columns)
+
+
+def sample_rows(record):
+    record = dict(record)
+    fields = dict(record.pop("fields", None) or {})
+    first_public_date = fields.pop("first_public_date", None)
+    if fields:
+        record["fields"] = fields
+    row = _with_extra(record, ["id", "source"])
+    row["first_public_date"] = first_public_date[0] if isinstance(first_public_date, list) else first_public_date
+    yield row
+
+
+def datalink_rows(record):
+    """one row per link of a EuroPMCLinks category record"""
+    for section in record.get("Section") or []:
+        for link in (section.get("Linklist") or {}).get("Link") or []:
+            source = link["Source"]["Identifier"]
+            target = link["Target"]
+            yield {"category": record["Name"], "obtained_by": section.get("ObtainedBy"),
+                   "source_scheme": source.get("IDScheme"), "source_id": source.get("ID"),
+                   "target_scheme": target["Identifier"].get("IDScheme"), "target_id": target["Identifier"].get("ID"),
+                   "target_title": target.get("Title")}
+
+
+SCHEMAS = {
+    "publication": RecordSchema("publication", PUBLICATION_FIELDS, publication_rows),
+    "sample": RecordSchema("sample", SAMPLE_FIELDS, sample_rows),
+    "datalink": RecordSchema("datalink", DATALINK_FIELDS, datalink_rows),
+    "accession": RecordSchema("accession", ACCESSION_FIELDS, lambda record: [record]),
+}
+
+
+class ParquetSink:
+    """
+    Writes records to a parquet file as they arrive, one row group every
+    row_group_size rows, with the columns of one of the SCHEMAS.
+    write_record takes a harvested record, write takes a row tuple in column
+    order (same interface as CSVSink, including the dedup modes).
+    Requires pyarrow.
+    """
+    DEFAULT_ROW_GROUP_SIZE = 64 * 1024
+
+    def __init__(self, path, schema, row_group_size=DEFAULT_ROW_GROUP_SIZE, compression="zstd",
+                 dedup=None, bloom_capacity=None):
+        _, pq = _pyarrow()
+        self.path = path
+        self.schema = SCHEMAS[schema] if isinstance(schema, str) else schema
+        self.row_group_size = row_group_size
+        self.dedup = RowDedup(dedup, bloom_capacity)
+        self.columns = [name for name, _ in self.schema.fields]
+        self._casts = {name: int if type_name.startswith("int") else str for name, type_name in self.schema.fields}
+        self.rows = 0
+        self._buffer = {column: [] for column in self.columns}
+        self._buffered = 0
+        self._writer = pq.ParquetWriter(path, self.schema.arrow_schema(), compression=compression)
+
+    def write_record(self, record):
+        for row in self.schema.to_rows(record):
+            self._append(row)
+
+    def write(self, row):
+        if not self.dedup.is_new(row):
+            return False
+        self._append(dict(zip(self.columns, row)))
+        return True
+
+    def _append(self, row):
+        for column in self.columns:
+            value = row.get(column)
+            if value is not None and not isinstance(value, self._casts[column]):
+                value = self._casts[column](value) if value != "" else None
+            self._buffer[column].append(value)
+        self._buffered += 1
+        if self._buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffered:
+            pa, _ = _pyarrow()
+            self._writer.write_table(pa.Table.from_pydict(self._buffer, schema=self._writer.schema))
+            self.rows += self._buffered
+            self._buffer = {column: [] for column in self.columns}
+            self._buffered = 0
+
+    def close(self):
+        if self._writer:
+            self.flush()
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
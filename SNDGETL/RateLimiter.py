@@ -0,0 +1,51 @@
+import threading
+import time
+import logging
+
+_log = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Token bucket per host: every host gets at most `rate` requests per second,
+    with bursts of up to `burst` requests. rate=None disables the limit.
+
+    The Transport also asks the limiter about every answer (record) and whether
+    a failed request should be retried (retry_delay), the plain limiter never retries.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def host_rate(self, host):
+        return self.rate
+
+    def acquire(self, host):
+        wait = self.reserve(host)
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self, host):
+        """
+        Takes the next request slot of the host without blocking and returns
+        the seconds to wait before using it (asyncio code awaits that instead of sleeping).
+        """
+        with self._lock:
+            rate = self.host_rate(host)
+            if not rate:
+                return 0
+            now = time.monotonic()
+            tokens, last = self._buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * rate) - 1
+            self._buckets[host] = (tokens, now)
+            return -tokens / rate if tokens < 0 else 0
+
+    def record(self, host, response):
+        pass
+
+    def retry_delay(self, attempt, response=None):
+        """seconds to wait before retrying a failed request, None to give up"""
+        return None
@@ -0,0 +1,154 @@
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+_log = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    On disk cache for http GET bodies.
+
+    Entries are keyed by the normalized url (scheme, host, path and the sorted
+    query params) and point to zlib compressed blobs named after the sha256 of
+    the body, so identical answers (ex: every empty datalinks response) are
+    stored once. An sqlite index keeps creation / access times for the TTL
+    checks and for the LRU eviction when the blobs go over max_size bytes.
+
+    endpoint_ttls maps url prefixes to a TTL in seconds, the longest matching
+    prefix wins, and ttl is used for everything else. A TTL of None never expires.
+    Search pages (SEARCH_PATHS) get SEARCH_TTL unless a prefix matches them:
+    their results change between runs, so they are stored (for offline runs
+    and benchmark fixtures) but never served as fresh. Only the lookups of a
+    single record (datalinks, ENA xml) are reused by the next runs.
+    """
+    DEFAULT_TTL = 7 * 24 * 3600
+    SEARCH_PATHS = ("/europepmc/webservices/rest/search", "/ebisearch/ws/rest/", "/content/search/")
+    SEARCH_TTL = 0
+    DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+    INDEX_FILE = "index.sqlite"
+
+    def __init__(self, cache_dir, ttl=DEFAULT_TTL, endpoint_ttls=None, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.endpoint_ttls = endpoint_ttls or {}
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(cache_dir, ResponseCache.INDEX_FILE),
+                                   timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                key TEXT PRIMARY KEY, url TEXT, digest TEXT, content_type TEXT,
+                                created REAL, accessed REAL)""")
+        self._db.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+        self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    @staticmethod
+    def normalize_url(url):
+        parts = urlsplit(url)
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ""))
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(ResponseCache.normalize_url(url).encode()).hexdigest()
+
+    def ttl_for(self, url):
+        url = ResponseCache.normalize_url(url)
+        prefixes = [p for p in self.endpoint_ttls if url.startswith(p)]
+        if prefixes:
+            return self.endpoint_ttls[max(prefixes, key=len)]
+        if urlsplit(url).path.startswith(ResponseCache.SEARCH_PATHS):
+            return ResponseCache.SEARCH_TTL
+        return self.ttl
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, "blobs", digest[:2], digest)
+
+    def get(self, url, expired=False):
+        """returns (body, content_type) or None when the url is not cached, or expired unless expired=True"""
+        key = ResponseCache.key(url)
+        with self._lock:
+            row = self._db.execute("SELECT digest, content_type, created FROM entries WHERE key = ?",
+                                   (key,)).fetchone()
+            if not row:
+                return None
+            digest, content_type, created = row
+            ttl = self.ttl_for(url)
+            if not expired and ttl is not None and time.time() - created > ttl:
+                return None
+            try:
+                with open(self._blob_path(digest), "rb") as h:
+                    body = zlib.decompress(h.read())
+            except (OSError, zlib.error):
+                _log.warning(f"broken cache entry for {url}")
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+        return body, content_type
+
+    def items(self):
+        """Yields (url, body, content_type) for every entry, expired or not. Used to export recorded runs"""
+        with self._lock:
+            rows = self._db.execute("SELECT url, digest, content_type FROM entries ORDER BY url").fetchall()
+        for url, digest, content_type in rows:
+            try:
+                with open(self._blob_path(digest), "rb") as h:
+                    yield url, zlib.decompress(h.read()), content_type
+            except (OSError, zlib.error):
+                _log.warning(f"broken cache entry for {url}")
+
+    def put(self, url, body, content_type=None):
+        key = ResponseCache.key(url)
+        digest = hashlib.sha256(body).hexdigest()
+        now = time.time()
+        with self._lock:
+            if not self._db.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone():
+                path = self._blob_path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                data = zlib.compress(body)
+                with open(path + ".tmp", "wb") as h:
+                    h.write(data)
+                os.replace(path + ".tmp", path)
+                self._db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?)", (digest, len(data)))
+                self.size += len(data)
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, ResponseCache.normalize_url(url), digest, content_type, now, now))
+            if self.max_size and self.size > self.max_size:
+                self._evict(int(self.max_size * 0.9))
+
+    def _evict(self, target_size):
+        evicted = 0
+        while self.size > target_size:
+            rows = self._db.execute("SELECT key, digest FROM entries ORDER BY accessed LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, digest in rows:
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                evicted += 1
+                if self._db.execute("SELECT 1 FROM entries WHERE digest = ?", (digest,)).fetchone():
+                    continue
+                size = self._db.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+                self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                if size:
+                    self.size -= size[0]
+                try:
+                    os.remove(self._blob_path(digest))
+                except FileNotFoundError:
+                    pass
+                if self.size <= target_size:
+                    break
+        _log.debug(f"evicted {evicted} cache entries, cache size: {self.size}")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,191 @@
+'''
+Joins the EBISearch sample hits with their full ENA records in one pass.
+'''
+import logging
+import threading
+from collections import OrderedDict
+
+from SNDGETL import init_log
+from SNDGETL.EBIENAAPI import EBIENAAPI, accession_batches
+from SNDGETL.ParallelFetcher import ParallelFetcher
+
+_log = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+def record_accessions(record):
+    """accession, primary / secondary ids and external ids (ex: BioSample) of an ENA xml record"""
+    if not isinstance(record, dict):
+        return set()
+    accessions = {record.get("@accession"), record.get("@alias")}
+    identifiers = record.get("IDENTIFIERS") or {}
+    for tag in ("PRIMARY_ID", "SECONDARY_ID", "EXTERNAL_ID"):
+        values = identifiers.get(tag)
+        for value in values if isinstance(values, list) else [values]:
+            accessions.add(value.get("#text") if isinstance(value, dict) else value)
+    accessions.discard(None)
+    return accessions
+
+
+class SampleEnricher:
+    """
+    Streams search hits (EBISearch entries) and resolves their accessions
+    through the ENA browser API, batch_size accessions per request and up to
+    `workers` requests at a time. The records are kept in an in memory LRU of
+    cache_size accessions, so an accession repeated in the stream is requested
+    once. Accessions ENA does not return are remembered as None.
+    """
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_CACHE_SIZE = 100000
+
+    def __init__(self, ena_api=None, batch_size=DEFAULT_BATCH_SIZE, workers=4, cache_size=DEFAULT_CACHE_SIZE):
+        self.ena_api = ena_api or EBIENAAPI()
+        self.batch_size = batch_size
+        self.workers = workers
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self._requested = set()
+        self._lock = threading.Lock()
+        self.lookups = 0
+
+    def enrich(self, docs, id_func=lambda doc: doc["id"]):
+        """
+        Yields (doc, record, exception) for every doc, in input order. record is
+        the ENA record of id_func(doc) or None when ENA does not have it, and
+        the docs of a failed request come with the exception. The accessions of
+        a failed request are requested again by the docs that come after it.
+        """
+        fetcher = ParallelFetcher(workers=self.workers, max_in_flight=self.workers * 2, ordered=True)
+        for (chunk, new), found, ex in fetcher.map(self._fetch, self._chunks(docs, id_func)):
+            with self._lock:
+                self._requested.difference_update(new)
+            if ex:
+                for doc in chunk:
+                    yield doc, None, ex
+                continue
+            for accession in new:
+                self._remember(accession, found.get(accession))
+            for doc in chunk:
+                accession = id_func(doc)
+                record = found[accession] if accession in found else self._recall(accession)
+                if record is _MISSING:
+                    # its request was in a chunk that failed (the next chunks were already made without
+                    # it), or it was evicted before its chunk came out, only with a tiny cache
+                    try:
+                        record = self._fetch(([], [accession]))[accession]
+                    except Exception as ex:
+                        yield doc, None, ex
+                        continue
+                    self._remember(accession, record)
+                yield doc, record, None
+
+    @staticmethod
+    def merge(doc, record):
+        """the search hit with the ENA record under "ena" """
+        merged = dict(doc)
+        merged["ena"] = record
+        return merged
+
+    def _chunks(self, docs, id_func):
+        """groups the docs in (docs, accessions to request) with batch_size new accessions at most"""
+        chunk = []
+        new = []
+        for doc in docs:
+            accession = id_func(doc)
+            chunk.append(doc)
+            with self._lock:
+                if accession not in self.cache and accession not in self._requested:
+                    self._requested.add(accession)
+                    new.append(accession)
+            if len(new) >= self.batch_size or len(chunk) >= self.batch_size * 10:
+                yield chunk, new
+                chunk = []
+                new = []
+        if chunk:
+            yield chunk, new
+
+    def _fetch(self, task):
+        _, new = task
+        found = {}
+        for batch in accession_batches(new, self.ena_api.endpoint, self.batch_size):
+            with self._lock:
+                self.lookups += len(batch)
+            for record in self.ena_api.query(batch):
+                for accession in record_accessions(record):
+                    found[accession] = record
+        return {accession: found.get(accession) for accession in new}
+
+    def _remember(self, accession, record):
+        with self._lock:
+            self.cache[accession] = record
+            self.cache.move_to_end(accession)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _recall(self, accession):
+        with self._lock:
+            record = self.cache.get(accession, _MISSING)
+            if record is not _MISSING:
+                self.cache.move_to_end(accession)
+            return record
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import json
+    import argparse
+    from tqdm import tqdm
+
+    from SNDGETL.JSONLines import add_compression_args, iter_jsonl, open_file
+    from SNDGETL.Metrics import add_metrics_args, metrics_from_args, metrics
+    from SNDGETL.Transport import add_transport_args, transport_from_args
+
+    parser = argparse.ArgumentParser(description='Adds the ENA record to every EBISearch sample')
+
+    parser.add_argument('json_file', action='store', help="json lines generated by SNDGETL.EBISearch, - for stdin")
+    parser.add_argument('-o', '--output', action='store', default=None,
+                        help="file to write the merged records to. Default: stdout")
+    parser.add_argument('--ena_endpoint', action='store', type=str,
+                        default=os.environ.get("ENA_ENDPOINT", EBIENAAPI.DEFAULT_ENDPOINT),
+                        help=f"default: {EBIENAAPI.DEFAULT_ENDPOINT}")
+    parser.add_argument('--batch_size', action='store', type=int, default=SampleEnricher.DEFAULT_BATCH_SIZE,
+                        help=f"accessions per ENA request. Default: {SampleEnricher.DEFAULT_BATCH_SIZE}")
+    parser.add_argument('--workers', action='store', type=int, default=4,
+                        help="concurrent ENA requests. Default 4")
+    parser.add_argument('--cache_size', action='store', type=int, default=SampleEnricher.DEFAULT_CACHE_SIZE,
+                        help=f"ENA records kept in memory. Default: {SampleEnricher.DEFAULT_CACHE_SIZE}")
+    add_transport_args(parser)
+    add_metrics_args(parser)
+    add_compression_args(parser)
+
+    parser.add_argument('-v', '--verbose', action="store_true")
+    parser.add_argument('-s', '--silent', action="store_true")
+
+    args = parser.parse_args()
+
+    if not args.verbose:
+        if os.environ.get('VERBOSE'):
+            args.verbose = True
+
+    if args.silent:
+        _log.disabled = True
+
+    init_log(rootloglevel=logging.DEBUG if args.verbose else logging.INFO)
+    metrics_from_args(args)
+
+    ena_api = EBIENAAPI(args.ena_endpoint, session=transport_from_args(args, min_pool_size=args.workers))
+    enricher = SampleEnricher(ena_api, batch_size=args.batch_size, workers=args.workers,
+                              cache_size=args.cache_size)
+    output = open_file(args.output or "-", "w", compression=args.compression)
+    with output:
+        for doc, record, ex in tqdm(enricher.enrich(iter_jsonl(args.json_file))):
+            if ex:
+                sys.stderr.write(f"error processing: {doc['id']}\n")
+                sys.stderr.write("\n")
+                continue
+            with metrics.timer("write_seconds", stage="samples"):
+                output.write(json.dumps(SampleEnricher.merge(doc, record)) + "\n")
+            metrics.records("samples")
+    _log.info(f"{enricher.lookups} accessions requested to ENA")
@@ -1,8 +1,8 @@
 import json
-import requests
 import logging
 
 from SNDGETL import init_log, ProcessingException
+from SNDGETL.Transport import default_transport
 
 _log = logging.getLogger(__name__)
 
@@ -14,9 +14,19 @@ _log = logging.getLogger(__name__)
 class Scopus:
     DEFAULT_ENDPOINT = "https://api.elsevier.com/content/search/scopus"
 
-    def __init__(self, apikey):
+    def __init__(self, apikey, endpoint=DEFAULT_ENDPOINT, session=None):
         self.apikey = apikey
+        self.endpoint = endpoint
+        self.session = session or default_transport()
 
     def doi(self, doi):
 
-        requests.get(f'{self.endpoint}?query=PMID({doi})&apiKey={self.apikey}&view=COMPLETE')
\ No newline at end of file
+        result = self.session.get(self.endpoint, params={"query": f"PMID({doi})", "apiKey": self.apikey,
+                                                         "view": "COMPLETE"})
+        if result.ok:
+            return result.json()
+        else:
+            ex = ProcessingException("error in http request",
+                                     data=[self.endpoint, result.status_code, result.text])
+            logging.error("error executing page handler", exc_info=ex)
+            raise ex
@@ -0,0 +1,81 @@
+import json
+import sqlite3
+import hashlib
+import datetime
+import logging
+
+_log = logging.getLogger(__name__)
+
+
+class StateStore:
+    """
+    Local sqlite state for incremental harvests. For every query (without its
+    date range) it keeps the latest publication date seen by a successful run,
+    the high water mark, and the ids already emitted with a hash of their
+    content, so the next run asks only for the records after the mark and
+    emits only the ones that are new or changed.
+
+    Nothing is stored until commit() is called, so a failed run leaves the
+    previous state untouched.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS watermarks (
+                                query_key TEXT PRIMARY KEY, last_date TEXT, updated TEXT)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS seen (
+                                query_key TEXT, id TEXT, digest TEXT,
+                                PRIMARY KEY (query_key, id)) WITHOUT ROWID""")
+        self._db.commit()
+        self._new_watermarks = {}
+
+    def watermark(self, query_key):
+        row = self._db.execute("SELECT last_date FROM watermarks WHERE query_key = ?", (query_key,)).fetchone()
+        return datetime.date.fromisoformat(row[0]) if row and row[0] else None
+
+    @staticmethod
+    def digest(doc, ignore_fields=()):
+        data = {k: v for k, v in doc.items() if k not in ignore_fields}
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def delta(self, query_key, results, id_func=lambda doc: doc["id"], date_func=None, ignore_fields=()):
+        """
+        Filters the [doc, total, idx] results of a client query down to the docs
+        that were not emitted before for query_key, or whose content changed.
+        date_func(doc) returns the date used to move the high water mark.
+        """
+        last_date = self.watermark(query_key)
+        for result in results:
+            doc = result[0]
+            if date_func:
+                date = date_func(doc)
+                if date and (last_date is None or date > last_date):
+                    last_date = date
+            doc_id = str(id_func(doc))
+            digest = StateStore.digest(doc, ignore_fields)
+            row = self._db.execute("SELECT digest FROM seen WHERE query_key = ? AND id = ?",
+                                   (query_key, doc_id)).fetchone()
+            if row and row[0] == digest:
+                continue
+            self._db.execute("INSERT OR REPLACE INTO seen VALUES (?, ?, ?)", (query_key, doc_id, digest))
+            yield result
+        self._new_watermarks[query_key] = last_date
+
+    def commit(self):
+        for query_key, last_date in self._new_watermarks.items():
+            self._db.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)",
+                             (query_key, last_date.isoformat() if last_date else None,
+                              datetime.datetime.now().isoformat()))
+        self._db.commit()
+        self._new_watermarks = {}
+
+    def close(self):
+        self._db.close()
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value[:10]) if value else None
+    except ValueError:
+        return None
@@ -0,0 +1,179 @@
+import io
+import os
+import time
+import threading
+import logging
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from SNDGETL import ProcessingException
+from SNDGETL.Governor import Governor
+from SNDGETL.Metrics import Metrics, metrics
+from SNDGETL.ResponseCache import ResponseCache
+
+_log = logging.getLogger(__name__)
+
+
+class Transport(requests.Session):
+    """
+    Pooled keep-alive http session shared by all the SNDGETL clients.
+    Every request gets the default timeout unless one is given, and waits
+    for the per host rate limiter when there is one. The limiter also decides
+    whether failed requests are retried (see Governor).
+
+    With a ResponseCache, successful GET responses are stored on disk and
+    served from there while they are fresh (search pages never are, see
+    ResponseCache.SEARCH_PATHS). offline=True never touches the network: it
+    uses the cached responses even when expired, and anything that is not in
+    the cache raises ProcessingException.
+
+    Every request is recorded in the process Metrics: latency and bytes per
+    endpoint, status codes, cache hits and retries.
+    """
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_TIMEOUT = (10, 120)
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, rate_limiter=None,
+                 cache=None, offline=False):
+        super().__init__()
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.offline = offline
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+
+    def request(self, method, url, params=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        cacheable = self.cache is not None and method.upper() == "GET"
+        if cacheable:
+            full_url = requests.Request(method, url, params=params).prepare().url
+            cached = self.cache.get(full_url, expired=self.offline)
+            if cached:
+                metrics.request(full_url, 0, 200, from_cache=True)
+                return Transport._cached_response(full_url, *cached)
+        if self.offline:
+            raise ProcessingException("running offline and the response is not cached",
+                                      data=[method, url, params])
+
+        host = urlparse(url).netloc
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire(host)
+            start = time.perf_counter()
+            try:
+                response = super().request(method, url, params=params, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                metrics.inc("http_errors_total", error=ex.__class__.__name__, endpoint=Metrics.endpoint_label(url))
+                delay = self.rate_limiter.retry_delay(attempt) if self.rate_limiter else None
+                if delay is None:
+                    raise
+                _log.warning(f"{ex.__class__.__name__} requesting {host}, retry {attempt + 1} in {delay:.1f}s")
+            else:
+                Transport._record(response, time.perf_counter() - start, kwargs.get("stream"))
+                if self.rate_limiter:
+                    self.rate_limiter.record(host, response)
+                delay = None
+                if self.rate_limiter and not response.ok:
+                    delay = self.rate_limiter.retry_delay(attempt, response)
+                if delay is None:
+                    break
+                _log.warning(f"http {response.status_code} from {host}, retry {attempt + 1} in {delay:.1f}s")
+                response.close()
+            metrics.inc("http_retries_total", endpoint=Metrics.endpoint_label(url))
+            time.sleep(delay)
+            attempt += 1
+
+        response.from_cache = False
+        if cacheable and response.ok:
+            self.cache.put(full_url, response.content, response.headers.get("Content-Type"))
+            response.raw = io.BytesIO(response.content)
+        return response
+
+    @staticmethod
+    def _record(response, seconds, stream):
+        # streamed bodies are still being downloaded, the header is the only size available
+        if stream:
+            nbytes = int(response.headers.get("Content-Length") or 0)
+        else:
+            nbytes = len(response.content)
+        metrics.request(response.url, seconds, response.status_code, nbytes)
+
+    @staticmethod
+    def _cached_response(url, body, content_type):
+        response = requests.Response()
+        response.url = url
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict({"Content-Type": content_type} if content_type else {})
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(body)
+        response.from_cache = True
+        return response
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def default_transport():
+    """Process wide Transport used by the clients when none is injected"""
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+        return _default_transport
+
+
+def add_transport_args(parser):
+    parser.add_argument('--pool_size', action='store', type=int, default=Transport.DEFAULT_POOL_SIZE,
+                        help=f"max open connections per host. Default: {Transport.DEFAULT_POOL_SIZE}")
+    parser.add_argument('--timeout', action='store', type=float, default=None,
+                        help=f"http read timeout in seconds. Default: {Transport.DEFAULT_TIMEOUT[1]}")
+    parser.add_argument('--rate', action='store', type=float, default=None,
+                        help="initial requests per second to each host, adjusted when the server "
+                             "throttles. Default: --max_rate")
+    parser.add_argument('--max_rate', action='store', type=float, default=Governor.DEFAULT_MAX_RATE,
+                        help=f"max requests per second to each host. Default: {Governor.DEFAULT_MAX_RATE}")
+    parser.add_argument('--retries', action='store', type=int, default=Governor.DEFAULT_RETRIES,
+                        help="retries for connection errors, throttling and 5xx answers, "
+                             f"with exponential backoff. Default: {Governor.DEFAULT_RETRIES}")
+    parser.add_argument('--cache_dir', '--cache-dir', action='store', default=os.environ.get("SNDGETL_CACHE_DIR"),
+                        help="directory for the on disk response cache. Default: no cache")
+    parser.add_argument('--cache_ttl', action='append', default=[], metavar="[URL_PREFIX=]SECONDS",
+                        help="cache entries lifetime, for every url or for the urls with a given prefix. "
+                             "Can be repeated. Search pages are only reused with a prefix TTL. "
+                             f"Default: {ResponseCache.DEFAULT_TTL}, {ResponseCache.SEARCH_TTL} for search pages")
+    parser.add_argument('--cache_max_size', action='store', type=int,
+                        default=ResponseCache.DEFAULT_MAX_SIZE // 1024 ** 2,
+                        help="cache size in MB before evicting the least recently used entries. "
+                             f"Default: {ResponseCache.DEFAULT_MAX_SIZE // 1024 ** 2}")
+    parser.add_argument('--offline', action="store_true",
+                        help="only use cached responses, expired or not, requires --cache_dir")
+
+
+def transport_from_args(args, min_pool_size=1):
+    timeout = (Transport.DEFAULT_TIMEOUT[0], args.timeout) if args.timeout else Transport.DEFAULT_TIMEOUT
+    cache = None
+    if args.cache_dir:
+        ttl = ResponseCache.DEFAULT_TTL
+        endpoint_ttls = {}
+        for value in args.cache_ttl:
+            if "=" in value:
+                prefix, seconds = value.rsplit("=", 1)
+                endpoint_ttls[ResponseCache.normalize_url(prefix)] = float(seconds)
+            else:
+                ttl = float(value)
+        cache = ResponseCache(args.cache_dir, ttl=ttl, endpoint_ttls=endpoint_ttls,
+                              max_size=args.cache_max_size * 1024 ** 2)
+    elif args.offline:
+        raise ValueError("--offline requires --cache_dir")
+    return Transport(pool_size=max(args.pool_size, min_pool_size), timeout=timeout,
+                     rate_limiter=Governor(rate=args.rate, max_rate=args.max_rate, retries=args.retries),
+                     cache=cache, offline=args.offline)
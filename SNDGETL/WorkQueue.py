@@ -0,0 +1,326 @@
+'''
+Splits a long EuroPMCLinks run (ex: a backfill of every publication since
+2000) in chunks of ids that several processes or nodes resolve at the same
+time, each one with its own IP and rate limit:
+
+    python -m SNDGETL.WorkQueue /shared/queue.sqlite init publications.json --chunk_size 1000
+    python -m SNDGETL.WorkQueue /shared/queue.sqlite worker /shared/links --workers 8 --prefilter
+    python -m SNDGETL.WorkQueue /shared/queue.sqlite status
+'''
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+
+from SNDGETL import init_log
+from SNDGETL.JSONLines import compression_for, open_file
+from SNDGETL.Metrics import metrics
+
+_log = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    """
+    Chunks of ids in a sqlite file on storage shared by the workers. A worker
+    claims a pending chunk with a lease of lease_seconds, renews it while it
+    works and marks the chunk done when its output is written; the chunk of a
+    worker that died is claimed again once its lease expires. A chunk that
+    raised, or whose lease expired, max_attempts times is marked failed with
+    all its items, for status and retry_failed.
+
+    Claims are a single BEGIN IMMEDIATE transaction, so two workers never get
+    the same live chunk. The shared file system must support file locks
+    (local disks, NFS with locking). The lease times are wall clock, the
+    nodes clocks must agree within a small fraction of the lease.
+    """
+    DEFAULT_CHUNK_SIZE = 1000
+    DEFAULT_LEASE_SECONDS = 600
+    DEFAULT_MAX_ATTEMPTS = 3
+
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # no WAL: it does not work on network file systems
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS chunks (
+                                chunk INTEGER PRIMARY KEY, items TEXT, size INTEGER,
+                                state TEXT, worker TEXT, lease_expires REAL, attempts INTEGER,
+                                failed TEXT, updated REAL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS chunks_state ON chunks (state, lease_expires)")
+
+    def add(self, items, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Appends the items (json serializable ids) in chunks of chunk_size, returns the chunks added"""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            next_chunk = self._db.execute("SELECT COALESCE(MAX(chunk) + 1, 0) FROM chunks").fetchone()[0]
+            first = next_chunk
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    self._insert(next_chunk, chunk)
+                    next_chunk += 1
+                    chunk = []
+            if chunk:
+                self._insert(next_chunk, chunk)
+                next_chunk += 1
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return next_chunk - first
+
+    def _insert(self, chunk, items):
+        self._db.execute("INSERT INTO chunks VALUES (?, ?, ?, 'pending', NULL, NULL, 0, NULL, ?)",
+                         (chunk, json.dumps(items), len(items), time.time()))
+
+    def claim(self, worker):
+        """(chunk, items) of a pending chunk or of an expired lease, leased to worker. None when there is none"""
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            # workers that died on the chunk every time, ex: killed by the OOM killer
+            self._db.execute("""UPDATE chunks SET state = 'failed', lease_expires = NULL, failed = items, updated = ?
+                                WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?""",
+                             (now, now, self.max_attempts))
+            row = self._db.execute("""SELECT chunk, items FROM chunks
+                                      WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)
+                                      ORDER BY chunk LIMIT 1""", (now,)).fetchone()
+            if row:
+                self._db.execute("""UPDATE chunks SET state = 'leased', worker = ?, lease_expires = ?,
+                                    attempts = attempts + 1, updated = ? WHERE chunk = ?""",
+                                 (worker, now + self.lease_seconds, now, row[0]))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        # [source, id] pairs come back as tuples, the way EuroPMCLinks.query_many takes them
+        return row[0], [tuple(item) if isinstance(item, list) else item for item in json.loads(row[1])]
+
+    def renew(self, chunk, worker):
+        """Extends the lease, False when the chunk was leased to another worker meanwhile"""
+        now = time.time()
+        cursor = self._db.execute("""UPDATE chunks SET lease_expires = ?, updated = ?
+                                     WHERE chunk = ? AND worker = ? AND state = 'leased'""",
+                                  (now + self.lease_seconds, now, chunk, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, chunk, worker, failed=()):
+        """Marks the chunk done, with the items that could not be processed"""
+        cursor = self._db.execute("""UPDATE chunks SET state = 'done', lease_expires = NULL, failed = ?,
+                                     updated = ? WHERE chunk = ? AND worker = ? AND state = 'leased'""",
+                                  (json.dumps(list(failed)) if failed else None, time.time(), chunk, worker))
+        if cursor.rowcount != 1:
+            _log.warning(f"chunk {chunk} was leased to another worker before {worker} finished it")
+        return cursor.rowcount == 1
+
+    def release(self, chunk, worker):
+        """Gives an unfinished chunk back on a worker shutdown, without counting the attempt"""
+        self._db.execute("""UPDATE chunks SET state = 'pending', lease_expires = NULL, attempts = attempts - 1,
+                            updated = ? WHERE chunk = ? AND worker = ? AND state = 'leased'""",
+                         (time.time(), chunk, worker))
+
+    def fail(self, chunk, worker):
+        """Gives back a chunk that raised, it is marked failed after max_attempts"""
+        cursor = self._db.execute("""UPDATE chunks SET lease_expires = NULL, updated = ?,
+                                     state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                     failed = CASE WHEN attempts >= ? THEN items ELSE NULL END
+                                     WHERE chunk = ? AND worker = ? AND state = 'leased'""",
+                                  (time.time(), self.max_attempts, self.max_attempts, chunk, worker))
+        return cursor.rowcount == 1
+
+    def retry_failed(self):
+        """Sets the failed chunks and the done ones with failed items pending again, returns how many"""
+        return self._db.execute("""UPDATE chunks SET state = 'pending', failed = NULL, attempts = 0, updated = ?
+                                   WHERE state = 'failed' OR (state = 'done' AND failed IS NOT NULL)""",
+                                (time.time(),)).rowcount
+
+    def finished(self):
+        return self._db.execute("SELECT COUNT(*) FROM chunks WHERE state NOT IN ('done', 'failed')"
+                                ).fetchone()[0] == 0
+
+    def status(self):
+        now = time.time()
+        report = {"chunks": 0, "items": 0, "pending": 0, "leased": 0, "expired": 0, "done": 0, "failed": 0,
+                  "items_done": 0, "items_failed": 0, "workers": []}
+        workers = set()
+        for size, state, worker, lease_expires, failed in self._db.execute(
+                "SELECT size, state, worker, lease_expires, failed FROM chunks"):
+            report["chunks"] += 1
+            report["items"] += size
+            if state == "leased" and lease_expires < now:
+                state = "expired"
+            report[state] += 1
+            if state == "leased":
+                workers.add(worker)
+            elif state in ("done", "failed"):
+                failed = len(json.loads(failed)) if failed else 0
+                report["items_done"] += size - failed
+                report["items_failed"] += failed
+        report["workers"] = sorted(workers)
+        return report
+
+    def close(self):
+        self._db.close()
+
+
+def chunk_path(out_dir, chunk, compression=None):
+    extension = {"gzip": ".gz", "zstd": ".zst"}.get(compression, "")
+    return os.path.join(out_dir, f"chunk_{chunk:05d}.json{extension}")
+
+
+def run_worker(queue, api, out_dir, worker, source, workers=1, prefilter=None, compression=None, poll=None):
+    """
+    Claims chunks until none is left and writes the data links of each one to
+    chunk_NNNNN.json in out_dir, through a temporary file, so a chunk file is
+    always complete. With poll (seconds), it also waits for the chunks leased
+    by other workers, to take them over if their leases expire. A chunk that
+    raises is given back to the queue (see WorkQueue.fail) and the worker
+    goes on with the next one; a chunk whose lease was taken over by another
+    worker is dropped, that worker writes its file.
+    Returns the chunks processed.
+    """
+    processed = 0
+    while True:
+        claimed = queue.claim(worker)
+        if claimed is None:
+            if poll and not queue.finished():
+                time.sleep(poll)
+                continue
+            return processed
+        chunk, pmids = claimed
+        path = chunk_path(out_dir, chunk, compression)
+        tmp_path = f"{path}.{worker.replace(os.sep, '_')}.tmp"
+        _log.info(f"chunk {chunk}: {len(pmids)} ids")
+        failed = []
+        renewed = time.time()
+        owned = True
+        try:
+            with open_file(tmp_path, "w", compression=compression) as output:
+                for pmid, records, ex in api.query_many(source, pmids, workers=workers, prefilter=prefilter):
+                    if ex:
+                        failed.append(pmid)
+                    else:
+                        for record in records:
+                            output.write(json.dumps(record) + "\n")
+                        metrics.records("datalinks", len(records))
+                    if time.time() - renewed > queue.lease_seconds / 3:
+                        renewed = time.time()
+                        owned = queue.renew(chunk, worker)
+                        if not owned:
+                            break
+            # the renew also checks the lease is still ours right before the file is replaced
+            owned = owned and queue.renew(chunk, worker)
+            if owned:
+                os.replace(tmp_path, path)
+        except Exception:
+            _log.error(f"chunk {chunk} failed", exc_info=True)
+            queue.fail(chunk, worker)
+            continue
+        except BaseException:
+            queue.release(chunk, worker)
+            raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if not owned:
+            _log.warning(f"lost the lease of chunk {chunk}, another worker has it")
+            continue
+        if failed:
+            _log.warning(f"chunk {chunk}: {len(failed)} ids failed")
+        if queue.complete(chunk, worker, failed):
+            processed += 1
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    from SNDGETL.EuroPMC import EuroPMC
+    from SNDGETL.EuroPMCLinks import EuroPMCLinks, LinksPrefilter
+    from SNDGETL.JSONLines import add_compression_args, iter_jsonl
+    from SNDGETL.Metrics import add_metrics_args, metrics_from_args
+    from SNDGETL.Transport import add_transport_args, transport_from_args
+
+    parser = argparse.ArgumentParser(description='Resolves the data links of a publications file in leased chunks')
+
+    parser.add_argument('queue', action='store', help="sqlite file on storage shared by the workers")
+    parser.add_argument('--lease', action='store', type=float, default=WorkQueue.DEFAULT_LEASE_SECONDS,
+                        help=f"seconds before the chunk of a silent worker is re-issued. "
+                             f"Default {WorkQueue.DEFAULT_LEASE_SECONDS}")
+    parser.add_argument('--max_attempts', action='store', type=int, default=WorkQueue.DEFAULT_MAX_ATTEMPTS,
+                        help=f"claims of a chunk before it is marked failed. Default {WorkQueue.DEFAULT_MAX_ATTEMPTS}")
+    parser.add_argument('-v', '--verbose', action="store_true")
+    parser.add_argument('-s', '--silent', action="store_true")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init_subparser = subparsers.add_parser('init', help="adds the ids of a publications file to the queue")
+    init_subparser.add_argument('json_file', action='store', help="json generated by SNDGETL.EuroPMC")
+    init_subparser.add_argument('--chunk_size', action='store', type=int, default=WorkQueue.DEFAULT_CHUNK_SIZE,
+                                help=f"ids per chunk. Default {WorkQueue.DEFAULT_CHUNK_SIZE}")
+
+    worker_subparser = subparsers.add_parser('worker', help="resolves chunks until the queue is empty")
+    worker_subparser.add_argument('out_dir', action='store', help="directory for the chunk_NNNNN.json files")
+    worker_subparser.add_argument('--worker_id', action='store', default=f"{socket.gethostname()}:{os.getpid()}",
+                                  help="name of this worker in the queue. Default: host:pid")
+    worker_subparser.add_argument('--source', action='store', default=EuroPMCLinks.DEFAULT_SOURCE,
+                                  help="article's source. MED = Default")
+    worker_subparser.add_argument('--ebipmc_endpoint', action='store', type=str,
+                                  default=os.environ.get("EBIPMC_ENDPOINT", EuroPMCLinks.DEFAULT_ENDPOINT),
+                                  help=f"default: {EuroPMCLinks.DEFAULT_ENDPOINT}")
+    worker_subparser.add_argument('--workers', action='store', type=int, default=1,
+                                  help="concurrent requests of this worker. Default 1 (serial)")
+    worker_subparser.add_argument('--prefilter', action="store_true",
+                                  help="only request the datalinks of the articles that have them, "
+                                       "see EuroPMCLinks --prefilter")
+    worker_subparser.add_argument('--search_endpoint', action='store', default=EuroPMC.DEFAULT_ENDPOINT,
+                                  help=f"EuroPMC search used by --prefilter. Default: {EuroPMC.DEFAULT_ENDPOINT}")
+    worker_subparser.add_argument('--poll', action='store', type=float, default=None,
+                                  help="when there are no chunks left, wait for the leased ones checking every "
+                                       "N seconds, to take over those of dead workers. Default: exit")
+    add_transport_args(worker_subparser)
+    add_metrics_args(worker_subparser)
+    add_compression_args(worker_subparser)
+
+    subparsers.add_parser('status', help="chunks and ids per state")
+    subparsers.add_parser('retry', help="sets the failed chunks and the ones with failed ids pending again")
+
+    args = parser.parse_args()
+
+    if not args.verbose:
+        if os.environ.get('VERBOSE'):
+            args.verbose = True
+
+    if args.silent:
+        _log.disabled = True
+
+    init_log(rootloglevel=logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.command != "init" and not os.path.exists(args.queue):
+        parser.error(f"'{args.queue}' does not exist, create it with init")
+    queue = WorkQueue(args.queue, lease_seconds=args.lease, max_attempts=args.max_attempts)
+    if args.command == "init":
+        # articles without pmid (preprints, PMC only) are resolved with their own source and id
+        pmids = (pub["pmid"] or [pub["source"], pub["id"]]
+                 for pub in iter_jsonl(args.json_file, fields=("pmid", "source", "id")))
+        _log.info(f"{queue.add(pmids, chunk_size=args.chunk_size)} chunks added to {args.queue}")
+    elif args.command == "worker":
+        metrics_from_args(args)
+        os.makedirs(args.out_dir, exist_ok=True)
+        api = EuroPMCLinks(args.ebipmc_endpoint, session=transport_from_args(args, min_pool_size=args.workers))
+        prefilter = LinksPrefilter(api, args.search_endpoint) if args.prefilter else None
+        processed = run_worker(queue, api, args.out_dir, args.worker_id, args.source, workers=args.workers,
+                               prefilter=prefilter, compression=compression_for(".json", args.compression),
+                               poll=args.poll)
+        _log.info(f"{args.worker_id}: {processed} chunks processed")
+    elif args.command == "status":
+        sys.stdout.write(json.dumps(queue.status(), indent=2) + "\n")
+    elif args.command == "retry":
+        _log.info(f"{queue.retry_failed()} chunks pending again")
+    queue.close()
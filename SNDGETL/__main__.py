@@ -0,0 +1,49 @@
+'''
+Single entry point for the command line of every module:
+
+    python -m SNDGETL europmc -o publications.json affiliation Argentina --fromdate 2024-01-01
+    python -m SNDGETL links load_json publications.json -o pub_links.json
+
+Only the module of the command is imported, so listing the commands or a
+process that runs one of them does not pay for the imports of the others.
+'''
+import sys
+import runpy
+
+COMMANDS = {
+    "europmc": ("SNDGETL.EuroPMC", "publications of a EuroPMC query"),
+    "links": ("SNDGETL.EuroPMCLinks", "data links of EuroPMC publications"),
+    "ebisearch": ("SNDGETL.EBISearch", "EBI Search entries of a query"),
+    "ena": ("SNDGETL.EBIENAAPI", "ENA records of a list of accessions"),
+    "enrich": ("SNDGETL.SampleEnricher", "EBISearch samples joined with their ENA records"),
+    "queue": ("SNDGETL.WorkQueue", "data links of a publications file in chunks shared by several workers"),
+    "extract": ("SNDGETL.EBIAccessionExtractor", "accession tables from the data links"),
+    "index": ("SNDGETL.AccessionIndex", "lookups in the accession index"),
+    "pipeline": ("SNDGETL.pipeline", "publications, links and accessions in one process"),
+}
+
+
+def usage():
+    lines = ["usage: python -m SNDGETL <command> [-h] [args ...]", "", "commands:"]
+    lines += [f"  {name:<10} {description}" for name, (_, description) in COMMANDS.items()]
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ("-h", "--help"):
+        sys.stdout.write(usage())
+        return 0
+    if argv[0] not in COMMANDS:
+        sys.stderr.write(usage())
+        sys.stderr.write(f"\nunknown command: '{argv[0]}'\n")
+        return 2
+    module, _ = COMMANDS[argv[0]]
+    # runs the module as python -m would, with the rest of the arguments
+    sys.argv = [module] + argv[1:]
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+'''
+Runs EuroPMC -> EuroPMCLinks -> EBIAccessionExtractor in a single process.
+The stages are generators connected by bounded queues, so link resolution
+starts with the first page of publications and the extraction runs while
+both keep downloading.
+'''
+import sys
+import json
+import logging
+
+from SNDGETL import init_log
+from SNDGETL.EBIAccessionExtractor import EBIAccessionExtractor
+from SNDGETL.EuroPMC import EuroPMC
+from SNDGETL.EuroPMCLinks import EuroPMCLinks, LinksPrefilter
+from SNDGETL.Metrics import metrics
+from SNDGETL.ParallelFetcher import prefetch
+from SNDGETL.Transport import default_transport
+
+_log = logging.getLogger(__name__)
+
+
+class Pipeline:
+    DEFAULT_QUEUE_SIZE = 1000
+
+    def __init__(self, workdir, session=None, europmc_endpoint=EuroPMC.DEFAULT_ENDPOINT,
+                 links_endpoint=EuroPMCLinks.DEFAULT_ENDPOINT, workers=8, queue_size=DEFAULT_QUEUE_SIZE,
+                 publications_file=None, links_file=None, prefilter=False, **extractor_args):
+        """
+        publications_file / links_file: optional handles where the intermediate
+        json lines are copied, the same files the chained scripts write.
+        prefilter: skip the datalinks requests of the articles a LinksPrefilter
+        finds without links.
+        extractor_args are passed to EBIAccessionExtractor.
+        """
+        session = session or default_transport()
+        self.europmc = EuroPMC(europmc_endpoint, session=session)
+        self.links_api = EuroPMCLinks(links_endpoint, session=session)
+        self.prefilter = LinksPrefilter(self.links_api, europmc_endpoint) if prefilter else None
+        self.extractor = EBIAccessionExtractor(workdir, **extractor_args)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.publications_file = publications_file
+        self.links_file = links_file
+        self.stats = {"publications": 0, "links": 0, "errors": 0}
+
+    def publications(self, query, page_size=None, result_type=None, **params):
+        # without a copy of the publications the links step only needs their ids, in big idlist pages
+        fields = None if self.publications_file else EuroPMC.LINK_FIELDS
+        page_size = page_size or (EuroPMC.MAX_PAGE_SIZE if fields else 100)
+        for doc, _, _ in self.europmc.query(query, pageSize=page_size, resultType=result_type, prefetch=2,
+                                            fields=fields, **params):
+            self.stats["publications"] += 1
+            metrics.records("publications")
+            if self.publications_file:
+                self.publications_file.write(json.dumps(doc) + "\n")
+            yield doc
+
+    def links(self, publications):
+        # articles without pmid are resolved with their own source and id, like EuroPMCLinks load_json
+        pmids = (pub.get("pmid") or (pub["source"], pub["id"]) for pub in publications)
+        for pmid, records, ex in self.links_api.query_many(EuroPMCLinks.DEFAULT_SOURCE, pmids,
+                                                           workers=self.workers, prefilter=self.prefilter):
+            if ex:
+                self.stats["errors"] += 1
+                sys.stderr.write(f"error processing: {pmid}\n")
+                sys.stderr.write("\n")
+                continue
+            for record in records:
+                self.stats["links"] += 1
+                metrics.records("links")
+                if self.links_file:
+                    self.links_file.write(json.dumps(record) + "\n")
+                yield record
+
+    def run(self, query, **query_args):
+        publications = prefetch(self.publications(query, **query_args), self.queue_size)
+        links = prefetch(self.links(publications), self.queue_size)
+        with self.extractor:
+            for record in links:
+                self.extractor.save_data(record)
+        return self.stats
+
+
+if __name__ == "__main__":
+    import os
+    import argparse
+    import datetime
+
+    from SNDGETL.JSONLines import add_compression_args, open_file
+    from SNDGETL.Metrics import add_metrics_args, metrics_from_args
+    from SNDGETL.Transport import add_transport_args, transport_from_args
+
+    parser = argparse.ArgumentParser(description='Publications -> data links -> accessions in one streaming run')
+
+    parser.add_argument('workdir', action='store', help="dir to save the accession numbers")
+    parser.add_argument('--publications', action='store', default=None,
+                        help="also write the publications json lines to this file")
+    parser.add_argument('--links', action='store', default=None,
+                        help="also write the data links json lines to this file")
+    parser.add_argument('--europmc_endpoint', action='store', default=EuroPMC.DEFAULT_ENDPOINT)
+    parser.add_argument('--links_endpoint', action='store', default=EuroPMCLinks.DEFAULT_ENDPOINT)
+    parser.add_argument('--page_size', action='store', type=int, default=None,
+                        help=f"Default: 100 with --publications, {EuroPMC.MAX_PAGE_SIZE} without")
+    parser.add_argument('--result_type', action='store', choices=["idlist", "lite", "core"], default=None,
+                        help="Default: core with --publications, idlist without")
+    parser.add_argument('--sort', action='store', type=str, default="P_PDATE_D ASC")
+    parser.add_argument('--workers', action='store', type=int, default=8,
+                        help="concurrent data links requests. Default 8")
+    parser.add_argument('--prefilter', action="store_true",
+                        help="only request the datalinks of the articles a batched search finds with links")
+    parser.add_argument('--queue_size', action='store', type=int, default=Pipeline.DEFAULT_QUEUE_SIZE,
+                        help=f"max records waiting between stages. Default {Pipeline.DEFAULT_QUEUE_SIZE}")
+    add_transport_args(parser)
+    add_metrics_args(parser)
+    add_compression_args(parser)
+
+    parser.add_argument('-v', '--verbose', action="store_true")
+    parser.add_argument('-s', '--silent', action="store_true")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    query_subparser = subparsers.add_parser('query')
+    query_subparser.add_argument('ebi_query', action='store', help="query to the EBI PMC Site")
+
+    aff_subparser = subparsers.add_parser('affiliation')
+    aff_subparser.add_argument('affiliation', action="store", help="word to search in the affiliation")
+    aff_subparser.add_argument('--fromdate', action='store', help="ISO FORMAT: %Y-%m-%d",
+                               type=datetime.date.fromisoformat, default=None)
+    aff_subparser.add_argument('--no_refs', action="store_true", help="bring articles with no data")
+
+    args = parser.parse_args()
+
+    if not args.verbose:
+        if os.environ.get('VERBOSE'):
+            args.verbose = True
+
+    if args.silent:
+        _log.disabled = True
+
+    init_log(rootloglevel=logging.DEBUG if args.verbose else logging.INFO)
+    metrics_from_args(args)
+
+    if args.command == "query":
+        query = args.ebi_query
+    else:
+        query = EuroPMC.affiliation_query(args.affiliation, with_refs=not args.no_refs)
+        if args.fromdate:
+            query = EuroPMC.date_range_query(query, args.fromdate)
+    _log.debug(query)
+
+    os.makedirs(args.workdir, exist_ok=True)
+    publications_file = open_file(args.publications, "w", compression=args.compression) if args.publications else None
+    links_file = open_file(args.links, "w", compression=args.compression) if args.links else None
+
+    pipeline = Pipeline(args.workdir, session=transport_from_args(args, min_pool_size=args.workers),
+                        europmc_endpoint=args.europmc_endpoint, links_endpoint=args.links_endpoint,
+                        workers=args.workers, queue_size=args.queue_size,
+                        publications_file=publications_file, links_file=links_file, prefilter=args.prefilter)
+    stats = pipeline.run(query, page_size=args.page_size, result_type=args.result_type,
+                         format="json", sort=args.sort)
+    for h in (publications_file, links_file):
+        if h:
+            h.close()
+    _log.info(f"publications: {stats['publications']} links: {stats['links']} errors: {stats['errors']}")
@@ -0,0 +1,41 @@
+"""
+EuroPMC.query with and without page prefetch against a local mock server,
+writing every record as json like the CLI does.
+
+    python -m benchmarks.europmc_prefetch --hits 2000 --page_size 100 --latency 0.1
+"""
+import argparse
+import io
+import json
+import time
+
+from SNDGETL.EuroPMC import EuroPMC
+from benchmarks.mock_server import MockServer
+
+
+def run(api, page_size, prefetch, encodes):
+    out = io.StringIO()
+    start = time.perf_counter()
+    records = 0
+    for doc, _, _ in api.query("AFF:Argentina", pageSize=page_size, prefetch=prefetch, format="json"):
+        for _ in range(encodes):
+            out.write(json.dumps(doc))
+        records += 1
+    return records, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='EuroPMC page prefetch benchmark')
+    parser.add_argument('--hits', type=int, default=2000)
+    parser.add_argument('--page_size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.1, help="simulated server latency in seconds")
+    parser.add_argument('--prefetch', type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument('--encodes', type=int, default=20,
+                        help="json.dumps per record, to simulate slower consumers")
+    args = parser.parse_args()
+
+    with MockServer(latency=args.latency, hits=args.hits) as server:
+        print(f"{'prefetch':>8} {'records':>8} {'seconds':>8} {'rec/s':>8}")
+        for prefetch in args.prefetch:
+            records, elapsed = run(EuroPMC(server.url + "/search"), args.page_size, prefetch, args.encodes)
+            print(f"{prefetch:>8} {records:>8} {elapsed:>8.2f} {records / elapsed:>8.1f}")
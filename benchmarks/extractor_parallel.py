@@ -0,0 +1,83 @@
+"""
+EBIAccessionExtractor serial vs --workers N on the same data links file,
+for every --dedup mode: times both and checks the csv files are byte
+identical. The exit code is 1 when they differ.
+
+    python -m benchmarks.extractor_parallel --records 20000 --workers 4
+    python -m benchmarks.extractor_parallel --links pub_links.json --workers 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import filecmp
+import tempfile
+import subprocess
+
+from benchmarks.mock_server import datalinks_response
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEDUP_MODES = ("exact", "bloom", "none")
+
+
+def write_links(path, records, distinct):
+    """EuroPMCLinks output where ids repeat every `distinct` records, with the publication row of every link"""
+    with open(path, "w") as h:
+        for n in range(records):
+            pmid = str(30000000 + n % distinct)
+            for category in datalinks_response("MED", pmid)["dataLinkList"]["Category"]:
+                link = category["Section"][0]["Linklist"]["Link"][0]
+                # a second link of the same article, so the publication row repeats inside a record
+                pdb = {"Source": link["Source"],
+                       "Target": {"Identifier": {"ID": f"{n % 97}abc", "IDScheme": "PDB"}, "Title": "pdb"}}
+                h.write(json.dumps(category) + "\n")
+                h.write(json.dumps({"Name": "Protein Structures", "CountOfLinks": 2,
+                                    "Section": [{"ObtainedBy": "tm_accession",
+                                                 "Linklist": {"Link": [pdb, pdb]}}]}) + "\n")
+
+
+def extract(links, workdir, dedup, workers):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "SNDGETL.EBIAccessionExtractor", "-s", "--dedup", dedup,
+                    "--workers", str(workers), links, workdir], env=env, check=True)
+    return time.perf_counter() - start
+
+
+def same_files(dir1, dir2):
+    names = sorted(os.listdir(dir1))
+    if names != sorted(os.listdir(dir2)):
+        return False
+    return all(filecmp.cmp(os.path.join(dir1, name), os.path.join(dir2, name), shallow=False) for name in names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serial vs parallel EBIAccessionExtractor output and timing')
+    parser.add_argument('--links', default=None, help="EuroPMCLinks json lines. Default: a synthetic file")
+    parser.add_argument('--records', type=int, default=20000, help="synthetic articles")
+    parser.add_argument('--distinct', type=int, default=5000, help="distinct ids of the synthetic articles")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--dedup', nargs="+", choices=DEDUP_MODES, default=list(DEDUP_MODES))
+    args = parser.parse_args()
+
+    differences = []
+    with tempfile.TemporaryDirectory(prefix="sndgetl_extract_") as tmp:
+        links = args.links
+        if links is None:
+            links = os.path.join(tmp, "links.json")
+            write_links(links, args.records, args.distinct)
+        print(f"{'dedup':>6} {'serial s':>9} {'parallel s':>11} {'identical':>10}")
+        for dedup in args.dedup:
+            serial_dir = os.path.join(tmp, f"serial_{dedup}")
+            parallel_dir = os.path.join(tmp, f"parallel_{dedup}")
+            serial = extract(links, serial_dir, dedup, 1)
+            parallel = extract(links, parallel_dir, dedup, args.workers)
+            identical = same_files(serial_dir, parallel_dir)
+            if not identical:
+                differences.append(dedup)
+            print(f"{dedup:>6} {serial:>9.2f} {parallel:>11.2f} {str(identical):>10}")
+
+    if differences:
+        print(f"DIFFERENT OUTPUT with --dedup {' '.join(differences)}")
+    sys.exit(1 if differences else 0)
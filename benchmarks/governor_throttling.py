@@ -0,0 +1,97 @@
+"""
+EuroPMCLinks.query_many against a mock server that throttles above a given
+rate and fails a fraction of the requests, with and without the Governor.
+
+    python -m benchmarks.governor_throttling --pmids 400 --throttle_rate 40 --error_rate 0.02
+
+The Governor run is also checked, and the exit code is 1 if it fails: every
+request succeeds in the end, the host rate goes below --throttle_rate and
+no throttled request is retried before its Retry-After.
+"""
+import sys
+import argparse
+import logging
+import threading
+import time
+
+from SNDGETL.EuroPMCLinks import EuroPMCLinks
+from SNDGETL.Governor import Governor
+from SNDGETL.RateLimiter import RateLimiter
+from SNDGETL.Transport import Transport
+from benchmarks.mock_server import MockServer, RETRY_AFTER
+
+
+def run(server, limiter, pmids, workers):
+    api = EuroPMCLinks(server.url + "/{source}/{pmcid}/datalinks?format=json",
+                       session=Transport(rate_limiter=limiter, pool_size=workers))
+    server.httpd.requests = server.httpd.throttled_requests = 0
+    start = time.perf_counter()
+    errors = sum(1 for _, _, ex in api.query_many(EuroPMCLinks.DEFAULT_SOURCE, pmids, workers=workers) if ex)
+    return errors, time.perf_counter() - start
+
+
+def lowest_rates(governor, stop, interval=0.02):
+    """{host: lowest rate} of the governor, sampled until stop is set"""
+    lowest = {}
+    while not stop.wait(interval):
+        for host, rate in list(governor.rates.items()):
+            lowest[host] = min(rate, lowest.get(host, rate))
+    return lowest
+
+
+def early_retries(request_log, retry_after, slack=0.05):
+    """requests of a path that came before the Retry-After of its previous 429 answer"""
+    last_throttled = {}
+    early = []
+    for when, path, status in sorted(request_log):
+        throttled_at = last_throttled.pop(path, None)
+        if throttled_at is not None and when - throttled_at < retry_after - slack:
+            early.append((path, round(when - throttled_at, 3)))
+        if status == 429:
+            last_throttled[path] = when
+    return early
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Governor behaviour under throttling')
+    parser.add_argument('--pmids', type=int, default=400)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--throttle_rate', type=float, default=40)
+    parser.add_argument('--error_rate', type=float, default=0.02)
+    parser.add_argument('--max_rate', type=float, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    pmids = [str(30000000 + i) for i in range(args.pmids)]
+    with MockServer(latency=args.latency, throttle_rate=args.throttle_rate, error_rate=args.error_rate) as server:
+        print(f"{'limiter':>10} {'failed':>7} {'requests':>9} {'throttled':>10} {'seconds':>8} {'ok/s':>7}")
+        governor = Governor(max_rate=args.max_rate, backoff=0.2)
+        lowest = {}
+        for name, limiter in [("none", RateLimiter()), ("governor", governor)]:
+            # the checks below look at the last run, the governor one
+            server.httpd.request_log = []
+            stop = threading.Event()
+            sampler = threading.Thread(target=lambda: lowest.update(lowest_rates(governor, stop)))
+            sampler.start()
+            errors, elapsed = run(server, limiter, pmids, args.workers)
+            stop.set()
+            sampler.join()
+            print(f"{name:>10} {errors:>7} {server.httpd.requests:>9} {server.httpd.throttled_requests:>10} "
+                  f"{elapsed:>8.2f} {(len(pmids) - errors) / elapsed:>7.1f}")
+        print(f"governor rates: { {host: round(rate, 1) for host, rate in governor.rates.items()} }, "
+              f"lowest: { {host: round(rate, 1) for host, rate in lowest.items()} }")
+
+        failures = []
+        if errors:
+            failures.append(f"{errors} requests failed with the governor")
+        if server.httpd.throttled_requests and not any(rate < args.throttle_rate for rate in lowest.values()):
+            failures.append(f"the governor rate never went below the throttle rate {args.throttle_rate}")
+        early = early_retries(server.httpd.request_log, RETRY_AFTER)
+        if early:
+            failures.append(f"{len(early)} retries before Retry-After, ex: {early[:3]}")
+        if not server.httpd.throttled_requests:
+            failures.append("the server did not throttle, raise --workers or lower --throttle_rate")
+        for failure in failures:
+            print(f"FAILED {failure}")
+    sys.exit(1 if failures else 0)
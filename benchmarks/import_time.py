@@ -0,0 +1,70 @@
+"""
+Cold start of every command: wall time of a fresh interpreter importing the
+module of the command and of `python -m SNDGETL <command> --help`, the median
+of --repeat runs, next to a bare interpreter as the floor.
+
+    python -m benchmarks.import_time --repeat 10 --save import_time.json
+    python -m benchmarks.import_time --repeat 10 --baseline import_time.json
+
+-X importtime of a module lists what each of its imports costs:
+
+    python -X importtime -c "import SNDGETL.EuroPMC" 2>&1 | sort -t'|' -k2 -n | tail
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+from SNDGETL.__main__ import COMMANDS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wall_time(args, repeat):
+    """median seconds of running the python arguments in a new process"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, env=env, cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import and startup time of the SNDGETL commands')
+    parser.add_argument('--commands', nargs="+", choices=list(COMMANDS), default=list(COMMANDS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', default=None, help="write the results to this json file")
+    parser.add_argument('--baseline', default=None, help="json written by --save to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="startup time increase over the baseline reported as a regression. Default 0.2")
+    args = parser.parse_args()
+
+    floor = wall_time(["-c", "pass"], args.repeat)
+    print(f"{'command':>10} {'import ms':>10} {'--help ms':>10}   (bare interpreter {floor * 1000:.1f} ms)")
+    results = [{"command": "python", "import_ms": round(floor * 1000, 1), "help_ms": round(floor * 1000, 1)}]
+    for name in args.commands:
+        module, _ = COMMANDS[name]
+        result = {"command": name,
+                  "import_ms": round(wall_time(["-c", f"import {module}"], args.repeat) * 1000, 1),
+                  "help_ms": round(wall_time(["-m", "SNDGETL", name, "--help"], args.repeat) * 1000, 1)}
+        results.append(result)
+        print(f"{name:>10} {result['import_ms']:>10} {result['help_ms']:>10}")
+
+    if args.save:
+        with open(args.save, "w") as h:
+            json.dump({"args": vars(args), "results": results}, h, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as h:
+            baseline = {r["command"]: r for r in json.load(h)["results"]}
+        regressions = [(r, baseline[r["command"]]) for r in results[1:] if r["command"] in baseline
+                       and r["import_ms"] > baseline[r["command"]]["import_ms"] * (1 + args.tolerance)]
+        for result, base in regressions:
+            print(f"REGRESSION {result['command']}: {result['import_ms']} ms, baseline {base['import_ms']} ms")
+        sys.exit(1 if regressions else 0)
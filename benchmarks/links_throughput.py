@@ -0,0 +1,42 @@
+"""
+Throughput of EuroPMCLinks.query_many against a local mock server.
+
+    python -m benchmarks.links_throughput --pmids 500 --latency 0.05 --workers 1 8 32
+"""
+import argparse
+import time
+
+from SNDGETL.EuroPMCLinks import EuroPMCLinks
+from SNDGETL.RateLimiter import RateLimiter
+from SNDGETL.Transport import Transport
+from benchmarks.mock_server import MockServer
+
+
+def run(api, pmids, workers, ordered):
+    start = time.perf_counter()
+    records = errors = 0
+    for _, result, ex in api.query_many(EuroPMCLinks.DEFAULT_SOURCE, pmids, workers=workers, ordered=ordered):
+        if ex:
+            errors += 1
+        else:
+            records += len(result)
+    return records, errors, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='EuroPMCLinks load_json throughput benchmark')
+    parser.add_argument('--pmids', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.05, help="simulated server latency in seconds")
+    parser.add_argument('--workers', type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument('--rate', type=float, default=None, help="per host requests/second cap")
+    parser.add_argument('--ordered', action="store_true")
+    args = parser.parse_args()
+
+    pmids = [str(30000000 + i) for i in range(args.pmids)]
+    with MockServer(latency=args.latency) as server:
+        api = EuroPMCLinks(server.url + "/{source}/{pmcid}/datalinks?format=json",
+                           session=Transport(rate_limiter=RateLimiter(args.rate), pool_size=max(args.workers)))
+        print(f"{'workers':>8} {'records':>8} {'errors':>7} {'seconds':>8} {'req/s':>8}")
+        for workers in args.workers:
+            records, errors, elapsed = run(api, pmids, workers, args.ordered)
+            print(f"{workers:>8} {records:>8} {errors:>7} {elapsed:>8.2f} {len(pmids) / elapsed:>8.1f}")
@@ -0,0 +1,264 @@
+"""
+Minimal local stand-in for the EBI REST endpoints, used by the benchmarks.
+Every request sleeps `latency` seconds before answering, to simulate the
+round trip to the real servers. With throttle_rate the server answers 429
+(with Retry-After) to the requests over that many per second, and error_rate
+is the fraction of requests answered with a 500.
+
+The endpoints answer both on the short paths (/search, /MED/1/datalinks) and
+on the real EBI paths (/europepmc/webservices/rest/search, ...) with synthetic
+records. With fixtures, the responses recorded by any SNDGETL script run with
+--cache_dir are replayed first (see load_fixtures), and only the urls that
+were not recorded fall back to the synthetic answers.
+"""
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, urlunsplit, parse_qs, urlencode
+
+from SNDGETL.EuroPMC import EuroPMC
+from SNDGETL.ResponseCache import ResponseCache
+
+DATALINKS_RE = re.compile(r"/(?P<source>[^/]+)/(?P<pmcid>[^/]+)/datalinks$")
+EXT_ID_RE = re.compile(r"EXT_ID:(\w+)")
+RETRY_AFTER = 1
+
+
+def fixture_key(url):
+    """path and sorted query of a url, so recorded urls match whatever host they are requested from"""
+    parts = urlsplit(ResponseCache.normalize_url(url))
+    return urlunsplit(("", "", parts.path, parts.query, ""))
+
+
+def load_fixtures(cache_dir):
+    """{fixture_key: (body, content_type, origin)} of a ResponseCache directory"""
+    cache = ResponseCache(cache_dir, ttl=None, max_size=None)
+    fixtures = {}
+    for url, body, content_type in cache.items():
+        parts = urlsplit(url)
+        fixtures[fixture_key(url)] = (body, content_type, f"{parts.scheme}://{parts.netloc}")
+    cache.close()
+    return fixtures
+
+
+def has_links(pmcid, link_rate):
+    """same answer for an id every time, for about link_rate of the ids"""
+    return zlib.crc32(str(pmcid).encode()) % 1000 < link_rate * 1000
+
+
+def datalinks_response(source, pmcid, link_rate=1.0):
+    if not has_links(pmcid, link_rate):
+        return {"hitCount": 0}
+    link = {"Source": {"Identifier": {"ID": pmcid, "IDScheme": source}},
+            "Target": {"Identifier": {"ID": f"AB{pmcid}", "IDScheme": "ENA"}, "Title": f"sequence {pmcid}"}}
+    category = {"Name": "Nucleotide Sequences", "CountOfLinks": 1,
+                "Section": [{"ObtainedBy": "tm_accession", "Linklist": {"Link": [link]}}]}
+    return {"hitCount": 1, "dataLinkList": {"Category": [category]}}
+
+
+def publication(n, link_rate=1.0):
+    pmid = str(30000000 + n)
+    flag = "Y" if has_links(pmid, link_rate) else "N"
+    return {"id": pmid, "source": "MED", "pmid": pmid, "pmcid": f"PMC{9000000 + n}",
+            "doi": f"10.1000/sndg.{n}", "title": f"Synthetic publication {n}",
+            "authorString": "Doe J, Roe R.", "journalTitle": "J Synthetic Data", "pubYear": "2023",
+            "hasDbCrossReferences": flag, "hasLabsLinks": "N", "hasTMAccessionNumbers": flag,
+            "firstPublicationDate": "2023-01-01", "abstractText": "lorem ipsum " * 100}
+
+
+def europmc_search_response(base_url, params, hits, link_rate=1.0):
+    page_size = int(params.get("pageSize", ["25"])[0])
+    offset = int(params.get("cursorMark", ["0"])[0].replace("*", "0"))
+    ext_ids = EXT_ID_RE.findall(params.get("query", [""])[0])
+    if ext_ids:
+        # batched lookups by id (LinksPrefilter) find the synthetic pmids
+        numbers = [int(pmid) - 30000000 for pmid in ext_ids if pmid.isdigit()]
+        numbers = [n for n in numbers if 0 <= n < hits]
+        hits = len(numbers)
+        docs = [publication(n, link_rate) for n in numbers[offset:offset + page_size]]
+    else:
+        docs = [publication(n, link_rate) for n in range(offset, min(offset + page_size, hits))]
+    result_type = params.get("resulttype", ["core"])[0]
+    if result_type != "core":
+        docs = [EuroPMC.project(doc, EuroPMC.RESULT_TYPE_FIELDS[result_type]) for doc in docs]
+    data = {"hitCount": hits, "resultList": {"result": docs}}
+    if offset + page_size < hits:
+        next_params = {k: v[0] for k, v in params.items()}
+        next_params["cursorMark"] = str(offset + page_size)
+        data["nextPageUrl"] = f"{base_url}/search?{urlencode(next_params)}"
+    return data
+
+
+def ebisearch_response(domain, params, hits):
+    size = int(params.get("size", ["15"])[0])
+    start = int(params.get("start", ["0"])[0])
+    entries = [{"id": f"SAMEA{1000000 + n}", "source": domain}
+               for n in range(start, min(start + size, hits))]
+    return {"hitCount": hits, "entries": entries}
+
+
+def ena_sample(accession):
+    attributes = "".join(f"<SAMPLE_ATTRIBUTE><TAG>{tag}</TAG><VALUE>{value}</VALUE></SAMPLE_ATTRIBUTE>"
+                         for tag, value in [("geographic location (country and/or sea)", "Argentina"),
+                                            ("collection date", "2021-03-01"), ("host", "Homo sapiens")])
+    return (f'<SAMPLE alias="{accession}" accession="{accession}" broker_name="SNDG">'
+            f'<IDENTIFIERS><PRIMARY_ID>{accession}</PRIMARY_ID>'
+            f'<EXTERNAL_ID namespace="BioSample">{accession}</EXTERNAL_ID></IDENTIFIERS>'
+            f'<TITLE>Sample {accession}</TITLE>'
+            f'<SAMPLE_NAME><TAXON_ID>9606</TAXON_ID><SCIENTIFIC_NAME>Homo sapiens</SCIENTIFIC_NAME></SAMPLE_NAME>'
+            f'<SAMPLE_ATTRIBUTES>{attributes}</SAMPLE_ATTRIBUTES></SAMPLE>')
+
+
+def ena_response(accessions):
+    samples = "".join(ena_sample(accession) for accession in accessions)
+    return f'<?xml version="1.0" encoding="UTF-8"?><SAMPLE_SET>{samples}</SAMPLE_SET>'.encode()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_fixture(self, body, content_type, origin):
+        # absolute urls in the recorded bodies (ex: nextPageUrl) point back to the mock server
+        body = body.replace(origin.encode(), self.server.base_url.encode())
+        self.send_response(200)
+        self.send_header("Content-Type", content_type or "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_xml(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.server.throttled():
+            self.server.log_request(self.path, 429)
+            self.send_response(429)
+            self.send_header("Retry-After", str(RETRY_AFTER))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.log_request(self.path, 500)
+            self.send_json({"error": "internal server error"}, status=500)
+            return
+        self.server.log_request(self.path, 200)
+        fixture = self.server.fixtures.get(fixture_key(self.path))
+        if fixture:
+            self.send_fixture(*fixture)
+            return
+        url = urlsplit(self.path)
+        match = DATALINKS_RE.search(url.path)
+        if url.path.endswith("/search"):
+            self.send_json(europmc_search_response(self.server.base_url + url.path[:-len("/search")],
+                                                   parse_qs(url.query), self.server.hits, self.server.link_rate))
+        elif "/ena/browser/api/xml/" in url.path:
+            self.send_xml(ena_response(url.path.rsplit("/", 1)[1].split(",")))
+        elif "/ebisearch/ws/rest/" in url.path:
+            domain = url.path.rsplit("/", 1)[1]
+            self.send_json(ebisearch_response(domain, parse_qs(url.query), self.server.hits))
+        elif match:
+            self.send_json(datalinks_response(match["source"], match["pmcid"], self.server.link_rate))
+        else:
+            self.send_json({"error": "not found"}, status=404)
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency, hits, throttle_rate, error_rate, fixtures=None, link_rate=1.0):
+        super().__init__(address, MockHandler)
+        self.link_rate = link_rate
+        self.base_url = "http://%s:%d" % self.server_address[:2]
+        self.fixtures = fixtures or {}
+        self.latency = latency
+        self.hits = hits
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.requests = 0
+        self.throttled_requests = 0
+        # (monotonic time, path, 429 / 500 / 200 when answered) of every request when set to a list
+        self.request_log = None
+        self._tokens = throttle_rate or 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def throttled(self):
+        with self._lock:
+            self.requests += 1
+            if not self.throttle_rate:
+                return False
+            now = time.monotonic()
+            self._tokens = min(self.throttle_rate, self._tokens + (now - self._last) * self.throttle_rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return False
+            self.throttled_requests += 1
+            return True
+
+    def log_request(self, path, status):
+        if self.request_log is not None:
+            with self._lock:
+                self.request_log.append((time.monotonic(), path, status))
+
+
+class MockServer:
+    def __init__(self, latency=0.05, hits=1000, throttle_rate=None, error_rate=0, host="127.0.0.1", port=0,
+                 fixtures_dir=None, link_rate=1.0):
+        fixtures = load_fixtures(fixtures_dir) if fixtures_dir else None
+        self.httpd = MockHTTPServer((host, port), latency, hits, throttle_rate, error_rate, fixtures, link_rate)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serves the mock EBI endpoints until interrupted')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--hits', type=int, default=1000)
+    parser.add_argument('--throttle_rate', type=float, default=None)
+    parser.add_argument('--error_rate', type=float, default=0)
+    parser.add_argument('--fixtures', default=None, help="--cache_dir of a recorded run to replay")
+    parser.add_argument('--link_rate', type=float, default=1.0, help="fraction of articles with data links")
+    args = parser.parse_args()
+
+    with MockServer(latency=args.latency, hits=args.hits, throttle_rate=args.throttle_rate,
+                    error_rate=args.error_rate, port=args.port, fixtures_dir=args.fixtures,
+                    link_rate=args.link_rate) as server:
+        print(f"serving on {server.url}, {len(server.httpd.fixtures)} recorded responses")
+        server.thread.join()
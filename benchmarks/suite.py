@@ -0,0 +1,202 @@
+"""
+Offline benchmark of every client and of the extractor against the mock
+server, reporting records/s, p50/p99 request latency and peak RSS.
+
+    python -m benchmarks.suite --hits 2000 --latency 0.02 --save baseline.json
+    python -m benchmarks.suite --hits 2000 --latency 0.02 --baseline baseline.json
+
+Each scenario runs in its own process, so the RSS is the peak of that
+scenario alone. Scenarios that need input ids (datalinks, ena, extractor)
+get them from the mock server first, outside of the measured time, the same
+way the chained scripts do, so a --fixtures run replays a recorded chain:
+run EuroPMC, EuroPMCLinks, EBISearch and EBIENAAPI with --cache_dir against
+the real API and pass that directory here, with the same queries and --page_size.
+With --baseline, scenarios slower than the baseline by more than --tolerance
+are reported and the exit code is 1.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import resource
+import tempfile
+import multiprocessing
+
+from SNDGETL.EBIAccessionExtractor import EBIAccessionExtractor
+from SNDGETL.EBIENAAPI import EBIENAAPI
+from SNDGETL.EBISearch import EBISearch
+from SNDGETL.EuroPMC import EuroPMC
+from SNDGETL.EuroPMCLinks import EuroPMCLinks, LinksPrefilter
+from SNDGETL.Governor import Governor
+from SNDGETL.Metrics import metrics
+from SNDGETL.Transport import Transport
+from benchmarks.mock_server import MockServer
+
+EUROPMC_PATH = "/europepmc/webservices/rest/search"
+LINKS_PATH = "/europepmc/webservices/rest/{source}/{pmcid}/datalinks?format=json"
+EBISEARCH_PATH = "/ebisearch/ws/rest/"
+ENA_PATH = "/ena/browser/api/xml/{accession}"
+
+
+def transport(config):
+    # short backoff so the injected errors do not dominate the timings
+    return Transport(pool_size=config["workers"],
+                     rate_limiter=Governor(max_rate=config["max_rate"], backoff=0.05, max_backoff=1))
+
+
+def publications(url, config, session):
+    api = EuroPMC(url + EUROPMC_PATH, session=session)
+    return (doc for doc, _, _ in api.query(config["europmc_query"], pageSize=config["page_size"], prefetch=2,
+                                           format="json", sort=config["sort"]))
+
+
+def samples(url, config, session):
+    api = EBISearch(config["domain"], url + EBISEARCH_PATH, page_size=config["page_size"], session=session)
+    if config["workers"] > 1:
+        results = api.query_sharded(config["ebisearch_query"], workers=config["workers"])
+    else:
+        results = api.query(config["ebisearch_query"])
+    return (doc for doc, _, _ in results)
+
+
+def links(url, config, session, pmids):
+    api = EuroPMCLinks(url + LINKS_PATH, session=session)
+    prefilter = LinksPrefilter(api, url + EUROPMC_PATH) if config["prefilter"] else None
+    for _, records, ex in api.query_many(EuroPMCLinks.DEFAULT_SOURCE, pmids, workers=config["workers"],
+                                         prefilter=prefilter):
+        yield from records or []
+
+
+def pub_ids(docs):
+    return [doc.get("pmid") or (doc["source"], doc["id"]) for doc in docs]
+
+
+def scenario_europmc(url, config, session, workdir):
+    return lambda: sum(1 for _ in publications(url, config, session))
+
+
+def scenario_ebisearch(url, config, session, workdir):
+    return lambda: sum(1 for _ in samples(url, config, session))
+
+
+def scenario_datalinks(url, config, session, workdir):
+    pmids = pub_ids(publications(url, config, session))
+    return lambda: sum(1 for _ in links(url, config, session, pmids))
+
+
+def scenario_ena(url, config, session, workdir):
+    accessions = [doc["id"] for doc in samples(url, config, session)]
+    api = EBIENAAPI(url + ENA_PATH, session=session)
+
+    def run():
+        results = api.query_batched(accessions, workers=config["workers"])
+        return sum(len(records) for _, records, ex in results if not ex)
+
+    return run
+
+
+def scenario_extractor(url, config, session, workdir):
+    """records are the data links records parsed"""
+    links_file = os.path.join(workdir, "links.json")
+    with open(links_file, "w") as h:
+        for record in links(url, config, session, pub_ids(publications(url, config, session))):
+            h.write(json.dumps(record) + "\n")
+
+    def run():
+        records = 0
+        with EBIAccessionExtractor(workdir) as extractor, open(links_file) as h:
+            for line in h:
+                extractor.save_data(json.loads(line))
+                records += 1
+        return records
+
+    return run
+
+
+SCENARIOS = {"europmc": scenario_europmc, "ebisearch": scenario_ebisearch, "datalinks": scenario_datalinks,
+             "ena": scenario_ena, "extractor": scenario_extractor}
+
+
+def run_scenario(name, url, config):
+    """runs in a fresh process: prepares the inputs, then measures only the scenario itself"""
+    logging.basicConfig(level=logging.CRITICAL)
+    session = transport(config)
+    with tempfile.TemporaryDirectory(prefix="sndgetl_bench_") as workdir:
+        run = SCENARIOS[name](url, config, session, workdir)
+        metrics.reset()
+        start = time.perf_counter()
+        records = run()
+        elapsed = time.perf_counter() - start
+    latencies = metrics.summary()["histograms"].get("http_request_seconds", [])
+    latency = max(latencies, key=lambda h: h["count"]) if latencies else {}
+    retries = sum(c["value"] for c in metrics.summary()["counters"].get("http_retries_total", []))
+    return {"scenario": name, "records": records, "seconds": round(elapsed, 3),
+            "records_per_second": round(records / elapsed, 1) if elapsed else None,
+            "p50_ms": round(latency["p50"] * 1000, 2) if latency else None,
+            "p99_ms": round(latency["p99"] * 1000, 2) if latency else None,
+            "retries": retries,
+            # ru_maxrss is in KB on linux and in bytes on macOS
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                                 / (1024 ** 2 if sys.platform == "darwin" else 1024), 1)}
+
+
+def fmt(value):
+    return "-" if value is None else str(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmark of the SNDGETL clients')
+    parser.add_argument('--scenarios', nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--hits', type=int, default=1000, help="synthetic results per query")
+    parser.add_argument('--latency', type=float, default=0.02, help="simulated server latency in seconds")
+    parser.add_argument('--error_rate', type=float, default=0, help="fraction of requests answered with a 500")
+    parser.add_argument('--throttle_rate', type=float, default=None,
+                        help="requests per second over which the server answers 429")
+    parser.add_argument('--fixtures', default=None, help="--cache_dir of a recorded run to replay")
+    parser.add_argument('--link_rate', type=float, default=1.0, help="fraction of articles with data links")
+    parser.add_argument('--prefilter', action="store_true", help="datalinks requests through a LinksPrefilter")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--max_rate', type=float, default=1000, help="Governor max requests per second")
+    parser.add_argument('--page_size', type=int, default=100)
+    parser.add_argument('--europmc_query', default="AFF:Argentina AND HAS_XREFS:y AND sort_date:y")
+    parser.add_argument('--sort', default="P_PDATE_D ASC", help="EuroPMC sort, the EuroPMC script default")
+    parser.add_argument('--ebisearch_query', default="country:Argentina")
+    parser.add_argument('--domain', default=EBISearch.DEFAULT_DB)
+    parser.add_argument('--save', default=None, help="write the results to this json file")
+    parser.add_argument('--baseline', default=None, help="json written by --save to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="records/s drop over the baseline reported as a regression. Default 0.2")
+    args = parser.parse_args()
+
+    config = {k: getattr(args, k) for k in ("workers", "max_rate", "page_size", "europmc_query",
+                                            "sort", "ebisearch_query", "domain", "prefilter")}
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with MockServer(latency=args.latency, hits=args.hits, throttle_rate=args.throttle_rate,
+                    error_rate=args.error_rate, fixtures_dir=args.fixtures, link_rate=args.link_rate) as server:
+        print(f"{'scenario':>10} {'records':>8} {'seconds':>8} {'records/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'retries':>8} {'rss MB':>7}")
+        for name in args.scenarios:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_scenario, (name, server.url, config))
+            results.append(result)
+            print(f"{name:>10} {result['records']:>8} {result['seconds']:>8} {result['records_per_second']:>10} "
+                  f"{fmt(result['p50_ms']):>8} {fmt(result['p99_ms']):>8} {result['retries']:>8} "
+                  f"{result['peak_rss_mb']:>7}")
+
+    if args.save:
+        with open(args.save, "w") as h:
+            json.dump({"args": vars(args), "results": results}, h, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as h:
+            baseline = {r["scenario"]: r for r in json.load(h)["results"]}
+        regressions = [(r, baseline[r["scenario"]]) for r in results if r["scenario"] in baseline
+                       and r["records_per_second"] < baseline[r["scenario"]]["records_per_second"]
+                       * (1 - args.tolerance)]
+        for result, base in regressions:
+            print(f"REGRESSION {result['scenario']}: {result['records_per_second']} records/s, "
+                  f"baseline {base['records_per_second']}")
+        sys.exit(1 if regressions else 0)